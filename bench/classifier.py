@@ -0,0 +1,97 @@
+"""Micro-benchmark for the server's query classifier.
+
+Times classify_query over a corpus of realistic queries, both cold (memo
+cleared on every pass) and memoized. Also times the fuzzywuzzy-based
+is_git_related_query it replaced, when fuzzywuzzy is installed
+(`pip install -e .[bench]`).
+
+    python bench/classifier.py
+"""
+import os
+import re
+import time
+import argparse
+import importlib.util
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CORPUS = [
+    "find files larger than 100MB",
+    "show disk usage of current directory",
+    "undo last commit",
+    "list all branches sorted by last commit date",
+    "delete merged local branches",
+    "squash the last three commits",
+    "stash changes including untracked files",
+    "chekcout the previous branch",
+    "rebase onto main and keep my changes",
+    "download https://github.com/user/repo/archive/main.zip",
+    "curl the latest release from github",
+    "kill the process listening on port 8080",
+    "show memory usage per process",
+    "compress the logs directory into a tar.gz",
+    "extract archive.tar.gz into /tmp",
+    "count lines in all python files",
+    "replace foo with bar in every .txt file",
+    "list running pods in the staging namespace",
+    "restart a kubernetes deployment",
+    "get logs from the api pod",
+    "remove all stopped docker containers",
+    "build the Dockerfile and tag it as latest",
+    "restart nginx with systemctl",
+    "show journalctl logs for ssh since yesterday",
+    "enable the docker service at boot",
+    "show my public ip address",
+    "watch cpu temperature",
+    "list open files for a process",
+    "change owner of a directory recursively",
+    "generate an ssh key",
+]
+
+def load_server():
+    spec = importlib.util.spec_from_file_location('opk_server', os.path.join(ROOT, 'server', 'opk-server.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def fuzzy_is_git_related_query(query):
+    from fuzzywuzzy import fuzz
+
+    query = query.lower()
+    git_terms = ["git", "commit", "branch", "merge", "pull", "push", "rebase", "stash", "checkout", "clone"]
+    url_pattern = re.compile(r'https?://\S+|www\.\S+')
+    contains_git_term = any(fuzz.partial_ratio(term, query) > 85 for term in git_terms)
+    urls = url_pattern.findall(query)
+    git_in_url = any('git' in url.lower() for url in urls)
+    looks_like_download = any(command in query for command in ["curl", "wget"])
+    git_context = re.search(r'\b(use|using|with|in)\s+git\b', query) is not None
+    return (contains_git_term or git_context) and not (git_in_url or looks_like_download)
+
+def measure(label, classify, queries, passes, before_pass=None):
+    start = time.perf_counter()
+    for _ in range(passes):
+        if before_pass is not None:
+            before_pass()
+        for query in queries:
+            classify(query)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {elapsed / (passes * len(queries)) * 1e6:8.2f} us/query")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--passes', type=int, default=200)
+    args = parser.parse_args()
+
+    server = load_server()
+    print(f"{len(CORPUS)} queries x {args.passes} passes")
+    measure("classify_query (cold)", server.classify_query, CORPUS, args.passes, server.classify_query.cache_clear)
+    measure("classify_query (memoized)", server.classify_query, CORPUS, args.passes)
+    try:
+        import fuzzywuzzy  # noqa: F401
+    except ImportError:
+        print("fuzzywuzzy not installed, skipping the previous implementation")
+        return
+    measure("fuzzywuzzy is_git_related_query", fuzzy_is_git_related_query, CORPUS, max(args.passes // 10, 1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""Offline load test for opk-server.
+
+Starts the server against its built-in fake model ([fake] in config.ini),
+so no API key or network is needed, then drives /quick_suggest and
+/generate at each concurrency level over TCP and, on Linux, the Unix
+socket. Reports throughput, p50/p95/p99 latency, errors and server RSS.
+
+    python bench/load.py
+    python bench/load.py --concurrency 1 16 64 --requests 500 --latency 0.05
+    python bench/load.py --client 20    # also time `opk --quick` end to end
+
+The cache, local index and history are off unless --cache is given, so
+every request reaches the (fake) model.
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def write_config(home, args):
+    config_dir = os.path.join(home, '.config', 'optionk')
+    os.makedirs(config_dir)
+    cache = 'true' if args.cache else 'false'
+    config = f"""[optionk]
+port = {args.port}
+max_workers = {args.workers}
+workers = {args.processes}
+max_concurrent_requests = {args.workers}
+max_pending_requests = 100000
+request_timeout = 30
+startup_check = false
+socket = {os.path.join(home, 'server.sock')}
+
+[scheduler]
+quick = {args.workers}
+generate = {args.workers}
+batch = {args.workers}
+prefetch = 1
+
+[vertexai]
+enabled = false
+
+[google_ai_studio]
+enabled = false
+
+[fake]
+enabled = true
+latency = {args.latency}
+jitter = {args.jitter}
+chunk_delay = {args.chunk_delay}
+failure_rate = {args.failure_rate}
+requests_per_minute = {args.requests_per_minute}
+
+[cache]
+enabled = {cache}
+
+[local_index]
+enabled = {cache}
+
+[history]
+enabled = {cache}
+
+[prefetch]
+enabled = false
+"""
+    path = os.path.join(config_dir, 'config.ini')
+    with open(path, 'w') as f:
+        f.write(config)
+    return path
+
+def start_server(config_path, port, log_path):
+    log = open(log_path, 'w')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server', 'opk-server.py'), '--config', config_path],
+        stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"opk-server exited with {server.returncode}, see {log_path}")
+        try:
+            socket.create_connection(('localhost', port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    sys.exit(f"opk-server did not start within 30s, see {log_path}")
+
+def server_rss(pid):
+    """Current and peak resident memory in MB of the server and its workers, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids = [pid] + [int(child) for child in f.read().split()]
+        rss = peak = 0
+        for process in pids:
+            with open(f"/proc/{process}/status") as f:
+                fields = dict(line.split(':', 1) for line in f)
+            rss += int(fields['VmRSS'].split()[0]) / 1024
+            peak += int(fields['VmHWM'].split()[0]) / 1024
+    except OSError:
+        return None, None
+    return rss, peak
+
+def percentile(ordered, q):
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+async def drive(endpoint, transport, concurrency, requests, args):
+    import aiohttp
+
+    if transport == 'unix':
+        connector = aiohttp.UnixConnector(path=args.socket, limit=concurrency)
+    else:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+    # Distinct queries so the server can't coalesce or cache them, unless --cache asks for repeats
+    queries = [f"bench {endpoint} query {i}" for i in range(requests if not args.cache else 10)]
+    latencies = []
+    errors = 0
+    next_request = iter(range(requests))
+
+    async def worker(session):
+        nonlocal errors
+        for i in next_request:
+            start = time.perf_counter()
+            try:
+                async with session.post(
+                    f"http://localhost:{args.port}{endpoint}",
+                    json={'query': queries[i % len(queries)]}
+                ) as response:
+                    body = await response.read()
+                    if response.status != 200 or b'"error"' in body:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+def report(endpoint, transport, concurrency, latencies, errors, elapsed, pid):
+    rss, peak = server_rss(pid)
+    ordered = sorted(latencies) or [float('nan')]
+    ms = lambda seconds: f"{seconds * 1000:8.1f}"
+    memory = f"{rss:7.1f} {peak:7.1f}" if rss is not None else f"{'-':>7} {'-':>7}"
+    print(
+        f"{endpoint:<15} {transport:<5} {concurrency:>5} {len(latencies) / elapsed:9.1f} "
+        f"{ms(percentile(ordered, 0.5))} {ms(percentile(ordered, 0.95))} {ms(percentile(ordered, 0.99))} "
+        f"{errors:>6} {memory}"
+    )
+
+def time_client(home, runs):
+    env = dict(os.environ, HOME=home)
+    command = [sys.executable, os.path.join(ROOT, 'client', 'opk.py'), 'list files', '--quick']
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"\nopk --quick end to end: min {min(timings):.1f} ms, median {statistics.median(timings):.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help="Requests per endpoint, transport and concurrency level")
+    parser.add_argument('--endpoints', nargs='+', default=['/quick_suggest', '/generate'])
+    parser.add_argument('--transports', nargs='+', default=['tcp', 'unix'] if sys.platform.startswith('linux') else ['tcp'])
+    parser.add_argument('--workers', type=int, default=32, help="Server worker threads and concurrent request slots")
+    parser.add_argument('--processes', type=int, default=1, help="Server worker processes")
+    parser.add_argument('--latency', type=float, default=0.1, help="Fake model latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Extra random fake model latency, up to this many seconds")
+    parser.add_argument('--chunk-delay', type=float, default=0.01, help="Seconds between streamed lines")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Fraction of fake model calls that fail")
+    parser.add_argument('--requests-per-minute', type=float, default=0, help="Rate limit of the fake model (0 = none)")
+    parser.add_argument('--cache', action='store_true', help="Keep the cache on and repeat 10 queries")
+    parser.add_argument('--client', type=int, default=0, metavar='RUNS', help="Also time RUNS `opk --quick` invocations")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='opk-load-')
+    args.port = free_port()
+    args.socket = os.path.join(home, 'server.sock')
+    config_path = write_config(home, args)
+    log_path = os.path.join(home, 'server.log')
+    server = start_server(config_path, args.port, log_path)
+
+    try:
+        rss, _ = server_rss(server.pid)
+        if rss is not None:
+            print(f"server RSS after start: {rss:.1f} MB")
+        print(f"{'endpoint':<15} {'via':<5} {'conc':>5} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6} {'RSS MB':>7} {'peak':>7}")
+        for endpoint in args.endpoints:
+            for transport in args.transports:
+                for concurrency in args.concurrency:
+                    latencies, errors, elapsed = asyncio.run(drive(endpoint, transport, concurrency, args.requests, args))
+                    report(endpoint, transport, concurrency, latencies, errors, elapsed, server.pid)
+        if args.client:
+            time_client(home, args.client)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    print(f"\nserver log: {log_path}")
+
+if __name__ == '__main__':
+    main()
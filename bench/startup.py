@@ -0,0 +1,78 @@
+"""Cold-start benchmark for the `opk --quick` keybinding path.
+
+Runs each client file against a stub /quick_suggest server and reports
+wall-clock time per invocation next to a bare interpreter start, so the
+difference is the client's own overhead.
+
+Compare against an older client with:
+
+    git show <rev>:client/opk.py > /tmp/opk_before.py
+    python bench/startup.py /tmp/opk_before.py client/opk.py
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({'result': 'ls -la'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def time_runs(command, env, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def report(label, timings, baseline=None):
+    median = statistics.median(timings)
+    line = f"{label:<40} min {min(timings):7.1f} ms   median {median:7.1f} ms"
+    if baseline is not None:
+        line += f"   overhead {median - baseline:7.1f} ms"
+    print(line)
+    return median
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('clients', nargs='*', default=[os.path.join(ROOT, 'client', 'opk.py')])
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('localhost', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # The client reads ~/.config/optionk/config.ini, so point HOME at a throwaway one
+    home = tempfile.mkdtemp(prefix='opk-bench-')
+    os.makedirs(os.path.join(home, '.config', 'optionk'))
+    with open(os.path.join(home, '.config', 'optionk', 'config.ini'), 'w') as f:
+        f.write(f"[optionk]\nport = {server.server_address[1]}\n")
+    env = dict(os.environ, HOME=home)
+
+    baseline = report("python -c pass", time_runs([sys.executable, '-c', 'pass'], env, args.runs))
+    for client in args.clients:
+        command = [sys.executable, client, 'list files', '--quick']
+        report(os.path.relpath(client), time_runs(command, env, args.runs), baseline)
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,452 @@
 import os
-import asyncio
-import aiohttp
 import sys
-from rich.console import Console
-from rich.panel import Panel
-from rich.table import Table
-from rich.text import Text
-import argparse
-from prompt_toolkit import PromptSession
-from prompt_toolkit.history import FileHistory, InMemoryHistory
-from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-from prompt_toolkit.application import Application
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.layout import Layout
-from prompt_toolkit.widgets import TextArea
-from prompt_toolkit.layout.containers import Window
-from prompt_toolkit.layout.controls import BufferControl
-from prompt_toolkit.formatted_text import HTML
-from prompt_toolkit.styles import Style
-from prompt_toolkit.buffer import Buffer
-import aiofiles
-import configparser
-import platform
-
-# Initialize the console
-console = Console()
+import json
+import math
+import time
+import socket
+from collections import deque
+
+# Only a few stdlib modules are imported up front so the --quick keybinding path starts fast.
+# rich, prompt_toolkit, aiohttp and sqlite3 are imported by the interactive UI, and
+# configparser and argparse only when they are actually needed.
+
+# Initialized by interactive() so the quick path never loads rich
+console = None
 
 def get_config_path():
-    if platform.system() == "Windows":
+    if os.name == "nt":
         config_path = os.path.join(os.environ.get('APPDATA'), 'optionk', 'config.ini')
     else:
         config_path = os.path.expanduser('~/.config/optionk/config.ini')
     return config_path
 
-# Replace the existing config reading
-config = configparser.ConfigParser()
-config.read(get_config_path())
+def load_settings():
+    """Read the client settings, from a JSON snapshot for as long as config.ini is unchanged.
 
-PORT = config.get('optionk', 'port', fallback='8089')
+    Importing configparser alone costs about as much as the rest of the --quick path.
+    """
+    config_path = get_config_path()
+    snapshot_path = os.path.join(os.path.dirname(config_path), 'client-settings.json')
+    try:
+        stat = os.stat(config_path)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+    except OSError:
+        stamp = None
+    try:
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+        if snapshot['stamp'] == stamp and stamp is not None:
+            return snapshot['settings']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
 
-# Update HISTORY_FILE path
-HISTORY_FILE = os.path.join(os.path.dirname(get_config_path()), 'history')
+    import configparser
 
-async def save_to_history(command):
-    try:
-        async with aiofiles.open(HISTORY_FILE, 'a') as f:
-            await f.write(f"{command}\n")
-    except ImportError:
-        # Fallback to synchronous file writing if aiofiles is not available
-        with open(HISTORY_FILE, 'a') as f:
-            f.write(f"{command}\n")
-
-async def load_history():
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    settings = {
+        'port': config.get('optionk', 'port', fallback='8089'),
+        # Shared with the server, which listens on this socket in addition to the TCP port on Linux
+        'socket': config.get(
+            'optionk', 'socket',
+            fallback='/run/zerocoretwo/server.sock' if sys.platform.startswith('linux') else ''
+        ),
+        'output_lines': config.getint('client', 'output_lines', fallback=20),
+        'output_limit': config.getint('client', 'output_limit', fallback=0),
+    }
+    if stamp is not None:
+        try:
+            with open(snapshot_path, 'w') as f:
+                json.dump({'stamp': stamp, 'settings': settings}, f)
+        except OSError:
+            pass
+    return settings
+
+settings = load_settings()
+PORT = settings['port']
+SOCKET_PATH = settings['socket']
+
+# Lines of command output kept on screen, and lines after which a command is stopped (0 = never)
+OUTPUT_LINES = settings['output_lines']
+OUTPUT_LIMIT = settings['output_limit']
+MAX_LINE_CHARS = 1000
+
+HISTORY_PATH = os.path.join(os.path.dirname(get_config_path()), 'history.db')
+# Plain history file written by older versions, imported into history.db once
+LEGACY_HISTORY_FILE = os.path.join(os.path.dirname(get_config_path()), 'history')
+
+def connect_unix_socket(timeout):
+    """Return a connected Unix socket to the server, or None to fall back to TCP."""
+    if not SOCKET_PATH or not hasattr(socket, 'AF_UNIX'):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
     try:
-        async with aiofiles.open(HISTORY_FILE, 'r') as f:
-            return [line.strip() for line in await f.readlines()]
-    except FileNotFoundError:
-        return []
+        sock.connect(SOCKET_PATH)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+def open_session():
+    import aiohttp
+
+    # One connector for the whole session so connections are kept alive between queries
+    probe = connect_unix_socket(timeout=1)
+    if probe is not None:
+        probe.close()
+        connector = aiohttp.UnixConnector(path=SOCKET_PATH)
+    else:
+        connector = aiohttp.TCPConnector()
+    return aiohttp.ClientSession(connector=connector)
+
+def post_json(path, payload, timeout=60):
+    """POST JSON over a plain socket; http.client alone costs ~25ms of imports."""
+    body = json.dumps(payload).encode()
+    request = (
+        f"POST {path} HTTP/1.0\r\n"
+        "Host: localhost\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ).encode() + body
+
+    sock = connect_unix_socket(timeout) or socket.create_connection(('localhost', int(PORT)), timeout=timeout)
+    with sock:
+        sock.sendall(request)
+        chunks = []
+        while chunk := sock.recv(65536):
+            chunks.append(chunk)
+
+    head, _, response_body = b"".join(chunks).partition(b"\r\n\r\n")
+    status = int(head.split(None, 2)[1])
+    if status != 200:
+        raise ConnectionError(f"server answered HTTP {status}")
+    return json.loads(response_body)
+
+def quick_suggest(query):
+    return post_json('/quick_suggest', {'query': query})['result']
+
+def prefetch(query):
+    # Keyed on the calling shell so each terminal only has one pending prefetch
+    post_json('/prefetch', {'query': query, 'session': os.getppid()}, timeout=1)
+
+# Frecency half-life: a command used a week ago counts half as much as one used now
+HISTORY_HALF_LIFE = 7 * 24 * 3600
+# Prefix matches read before switching to a walk down the frecency index
+HISTORY_SCAN_LIMIT = 1000
+
+def normalize_history_query(query):
+    return " ".join(query.lower().split())
+
+def add_frecency(score, now):
+    """Add one use at time now to a frecency score.
+
+    Scores are log2(sum(2 ** (t / half_life))) over all uses, so they only
+    grow and never need rescaling: ordering by score ranks by frecency at any
+    time, and an index on it gives top-k without a scan.
+    """
+    visit = now / HISTORY_HALF_LIFE
+    if score is None:
+        return visit
+    high, low = max(score, visit), min(score, visit)
+    return high + math.log2(1 + 2 ** (low - high))
+
+class HistoryStore:
+    """Command history in SQLite: an append-only log of runs plus frecency-ranked indexes.
+
+    Shared with opk-server, which answers repeated queries from it.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        # The edit prompt runs in a worker thread and asks for completions from there
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY, time REAL NOT NULL, query TEXT NOT NULL,
+                command TEXT NOT NULL, exit_code INTEGER, latency REAL);
+            CREATE TABLE IF NOT EXISTS commands (
+                command TEXT PRIMARY KEY, uses INTEGER NOT NULL, last_used REAL NOT NULL,
+                score REAL NOT NULL) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS commands_score ON commands (score);
+            CREATE TABLE IF NOT EXISTS queries (
+                query TEXT NOT NULL, command TEXT NOT NULL, uses INTEGER NOT NULL,
+                failures INTEGER NOT NULL, score REAL NOT NULL,
+                PRIMARY KEY (query, command)) WITHOUT ROWID;
+        """)
+
+    def import_plain_history(self, path):
+        """Load the plain one-command-per-line history file used by older versions."""
+        if not os.path.exists(path) or self.db.execute("SELECT 1 FROM commands LIMIT 1").fetchone():
+            return
+        mtime = os.path.getmtime(path)
+        with open(path) as f:
+            commands = [line.strip() for line in f if line.strip()]
+        self.db.execute("BEGIN")
+        for command in commands:
+            self._touch_command(command, mtime)
+        self.db.execute("COMMIT")
+
+    def record(self, query, command, exit_code=None, latency=None):
+        now = time.time()
+        query = normalize_history_query(query)
+        self.db.execute("BEGIN")
+        self.db.execute(
+            "INSERT INTO runs (time, query, command, exit_code, latency) VALUES (?, ?, ?, ?, ?)",
+            (now, query, command, exit_code, latency)
+        )
+        self._touch_command(command, now)
+        if query:
+            row = self.db.execute(
+                "SELECT uses, failures, score FROM queries WHERE query = ? AND command = ?", (query, command)
+            ).fetchone()
+            uses, failures, score = row or (0, 0, None)
+            self.db.execute(
+                "INSERT OR REPLACE INTO queries (query, command, uses, failures, score) VALUES (?, ?, ?, ?, ?)",
+                (query, command, uses + 1, failures + (exit_code not in (0, None)), add_frecency(score, now))
+            )
+        self.db.execute("COMMIT")
+
+    def _touch_command(self, command, now):
+        row = self.db.execute("SELECT uses, score FROM commands WHERE command = ?", (command,)).fetchone()
+        uses, score = row or (0, None)
+        self.db.execute(
+            "INSERT OR REPLACE INTO commands (command, uses, last_used, score) VALUES (?, ?, ?, ?)",
+            (command, uses + 1, now, add_frecency(score, now))
+        )
+
+    def complete(self, prefix):
+        """Most frecent command starting with prefix, without scanning the whole table.
+
+        A rare prefix is resolved from a bounded range scan on the primary key. A common one
+        walks the score index from the top, where a match turns up within a few rows.
+        """
+        if not prefix:
+            return None
+        bounds = (prefix, prefix + "\U0010ffff", prefix)
+        rows = self.db.execute(
+            "SELECT command, score FROM commands WHERE command >= ? AND command < ? AND command != ? LIMIT ?",
+            bounds + (HISTORY_SCAN_LIMIT,)
+        ).fetchall()
+        if len(rows) < HISTORY_SCAN_LIMIT:
+            return max(rows, key=lambda row: row[1])[0] if rows else None
+        row = self.db.execute(
+            "SELECT command FROM commands INDEXED BY commands_score "
+            "WHERE command >= ? AND command < ? AND command != ? ORDER BY score DESC LIMIT 1",
+            bounds
+        ).fetchone()
+        return row[0] if row else None
+
+    def top(self, limit):
+        """The limit most frecent commands, best first."""
+        return [row[0] for row in self.db.execute("SELECT command FROM commands ORDER BY score DESC LIMIT ?", (limit,))]
+
+    def close(self):
+        self.db.close()
+
+def history_auto_suggest(store):
+    from prompt_toolkit.auto_suggest import AutoSuggest, AutoSuggestFromHistory, Suggestion
+
+    class HistoryAutoSuggest(AutoSuggest):
+        """Suggest the most frecent past command that starts with what has been typed.
+
+        Falls back to the prompt's own history, which holds the command just offered
+        before it has ever been run.
+        """
+
+        def __init__(self):
+            self.session_history = AutoSuggestFromHistory()
+
+        def get_suggestion(self, buffer, document):
+            text = document.text
+            command = store.complete(text) if text.strip() else None
+            if command:
+                return Suggestion(command[len(text):])
+            return self.session_history.get_suggestion(buffer, document)
+
+    return HistoryAutoSuggest()
+
+class OutputTail:
+    """The last lines of a running command's output, rendered as a panel."""
+
+    def __init__(self, max_lines):
+        self.lines = deque(maxlen=max_lines)
+        self.total_lines = 0
+        self.status = None
+
+    def add(self, line, is_error):
+        self.total_lines += 1
+        # Cap each line so one huge line (minified JSON, binary noise) can't blow up the panel
+        self.lines.append((line[:MAX_LINE_CHARS], is_error))
+
+    def __rich__(self):
+        from rich.panel import Panel
+        from rich.text import Text
+
+        text = Text(no_wrap=True, overflow="ellipsis")
+        hidden = self.total_lines - len(self.lines)
+        if hidden:
+            text.append(f"... {hidden} earlier lines not shown\n", style="dim")
+        for line, is_error in self.lines:
+            text.append(line + "\n", style="red" if is_error else None)
+        text.rstrip()
+        title = "Command Output" if self.status is None else f"Command Output ({self.status})"
+        border_style = "green" if self.status is None or self.status.startswith("exit 0") else "red"
+        return Panel(text, title=title, expand=False, border_style=border_style)
+
+class CommandProtocol:
+    """Splits a subprocess's stdout/stderr into lines as the data arrives."""
+
+    def __init__(self, on_line, done):
+        self.on_line = on_line
+        self.done = done
+        self.partial = {1: b"", 2: b""}
+
+    def connection_made(self, transport):
+        pass
+
+    def pipe_data_received(self, fd, data):
+        *lines, self.partial[fd] = (self.partial[fd] + data).split(b"\n")
+        for line in lines:
+            self.on_line(line.decode(errors="replace").rstrip("\r"), fd == 2)
+        if len(self.partial[fd]) > MAX_LINE_CHARS * 4:
+            self.pipe_connection_lost(fd, None)
+
+    def pipe_connection_lost(self, fd, exc):
+        if self.partial[fd]:
+            self.on_line(self.partial[fd].decode(errors="replace"), fd == 2)
+            self.partial[fd] = b""
+
+    def process_exited(self):
+        pass
+
+    def connection_lost(self, exc):
+        # Called once the process has exited and both pipes are closed
+        if not self.done.done():
+            self.done.set_result(None)
+
+async def run_command(command, tail_lines=20, limit_lines=0):
+    """Run command, streaming its output into a live panel of the last tail_lines lines.
+
+    With limit_lines set the command is stopped once it has printed that many lines.
+    Ctrl+C stops the command instead of the session. Returns the exit status and the
+    run time in seconds; the exit status is None if the command could not be started.
+    """
+    import asyncio
+    import signal
+    from rich.live import Live
+
+    loop = asyncio.get_running_loop()
+    output = OutputTail(tail_lines)
+    done = loop.create_future()
+    limit_reached = False
+    interrupts = 0
+
+    def stop(kill=False):
+        # Closing our end of the pipes makes the rest of a pipeline exit on SIGPIPE, not just
+        # the shell, and stops us waiting on children that outlive it
+        transport.get_pipe_transport(1).close()
+        transport.get_pipe_transport(2).close()
+        if transport.get_returncode() is None:
+            transport.kill() if kill else transport.terminate()
+
+    def on_line(line, is_error):
+        nonlocal limit_reached
+        if limit_reached:
+            return
+        output.add(line, is_error)
+        if limit_lines and output.total_lines >= limit_lines:
+            limit_reached = True
+            stop()
+
+    def on_interrupt():
+        # The command shares our process group, so Ctrl+C from the terminal already reached it.
+        # A second press kills it outright; either way the interactive session keeps running.
+        nonlocal interrupts
+        interrupts += 1
+        if interrupts > 1:
+            stop(kill=True)
 
-async def run_command(command):
     try:
-        proc = await asyncio.create_subprocess_shell(
+        transport, _ = await loop.subprocess_shell(
+            lambda: CommandProtocol(on_line, done),
             command,
+            stdin=None,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
-        stdout, stderr = await proc.communicate()
-        if proc.returncode == 0:
-            return stdout.decode()
-        else:
-            return f"Error: {stderr.decode()}"
     except Exception as e:
-        return f"Error: {str(e)}"
+        console.print(f"[bold red]Error:[/bold red] {str(e)}")
+        return None, 0.0
+
+    try:
+        loop.add_signal_handler(signal.SIGINT, on_interrupt)
+        handles_interrupt = True
+    except (NotImplementedError, RuntimeError):
+        handles_interrupt = False  # Windows
+
+    start = time.perf_counter()
+    returncode, elapsed = None, 0.0
+    try:
+        with Live(console=console, get_renderable=output.__rich__, refresh_per_second=10):
+            await done
+            returncode = transport.get_returncode()
+            elapsed = time.perf_counter() - start
+            output.status = f"exit {returncode}, {elapsed:.2f}s"
+            if interrupts:
+                output.status = f"interrupted, {output.status}"
+            elif limit_reached:
+                output.status = f"stopped after {limit_lines} lines, {output.status}"
+    finally:
+        if handles_interrupt:
+            loop.remove_signal_handler(signal.SIGINT)
+        transport.close()  # Kills the command if we are leaving early
+    return returncode, elapsed
+
+def build_commands_table(commands):
+    from rich.table import Table
+    from rich.text import Text
+
+    table = Table(title="Generated Commands", show_header=True, header_style="bold magenta", expand=True)
+    table.add_column("#", style="dim", width=4, justify="center")
+    table.add_column("Command", style="cyan", no_wrap=True, ratio=30)
+    table.add_column("Explanation", style="green", ratio=70)
+
+    for i, (cmd, explanation) in enumerate(commands):
+        cmd_parts = cmd.split()
+
+        colored_cmd = Text()
+        for j, part in enumerate(cmd_parts):
+            if j == 0:
+                colored_cmd.append(part, style="bold cyan")
+            elif part.startswith('-'):
+                colored_cmd.append(f" {part}", style="yellow")
+            else:
+                colored_cmd.append(f" {part}", style="green")
+
+        table.add_row(str(i), colored_cmd, Text(explanation, style="green"))
+    return table
+
+async def stream_commands(session, query):
+    """Render suggestions as the server streams them and return (command, explanation) pairs."""
+    from rich.live import Live
+
+    commands = []
+    with Live(build_commands_table(commands), console=console, auto_refresh=False) as live:
+        async with session.post(f'http://localhost:{PORT}/generate_stream', json={'query': query}) as response:
+            async for raw_line in response.content:
+                if not raw_line.strip():
+                    continue
+                suggestion = json.loads(raw_line)
+                if 'error' in suggestion:
+                    raise RuntimeError(suggestion['error'])
+                if len(commands) < 10:  # Limit to 10 commands (0-9)
+                    commands.append((suggestion['command'], suggestion['explanation']))
+                    live.update(build_commands_table(commands), refresh=True)
+    return commands
 
 def apply_color_scheme_html(command):
     parts = command.split()
@@ -85,21 +460,52 @@ def apply_color_scheme_html(command):
             colored_parts.append(f'<param>{part}</param>')
     return ' '.join(colored_parts)
 
-async def main():
-    parser = argparse.ArgumentParser(description="AI Coding Assistant CLI")
-    parser.add_argument("query", nargs="*", help="The task or query to generate a command for")
-    parser.add_argument("--quick", action="store_true", help="Get a single best result")
-    args = parser.parse_args()
+async def interactive(user_input, tail_lines=OUTPUT_LINES, limit_lines=OUTPUT_LIMIT):
+    global console
+    import asyncio
+    from rich.console import Console
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.history import InMemoryHistory
+    from prompt_toolkit.application import Application
+    from prompt_toolkit.key_binding import KeyBindings
+    from prompt_toolkit.layout import Layout
+    from prompt_toolkit.layout.containers import Window
+    from prompt_toolkit.layout.controls import BufferControl
+    from prompt_toolkit.formatted_text import HTML
+    from prompt_toolkit.styles import Style
+    from prompt_toolkit.buffer import Buffer
 
-    user_input = " ".join(args.query)
+    console = Console()
+    history = HistoryStore(HISTORY_PATH)
+    history.import_plain_history(LEGACY_HISTORY_FILE)
 
-    async with aiohttp.ClientSession() as session:
-        if args.quick:
-            async with session.post(f'http://localhost:{PORT}/quick_suggest', json={'query': user_input}) as response:
-                data = await response.json()
-                print(data['result'])
-            return
+    # The selection and edit prompts are built once and reused for every query in the session
+    def handle_input(event):
+        event.app.exit(result=event.data)
+
+    kb = KeyBindings()
+    for key in [str(i) for i in range(10)] + ['n', 'q']:
+        kb.add(key)(handle_input)
+    selector = Application(
+        layout=Layout(Window(BufferControl(buffer=Buffer()))),
+        key_bindings=kb,
+        full_screen=False,
+    )
 
+    # Up arrow walks the suggestion first, then the most frecent past commands
+    edit_history = InMemoryHistory(history.top(100)[::-1])
+    edit_session = PromptSession(
+        history=edit_history,
+        auto_suggest=history_auto_suggest(history),
+        style=Style.from_dict({
+            'prompt': '#00FFFF bold',
+            'cmd': '#00FFFF bold',
+            'arg': '#FFFF00',
+            'param': '#00FF00',
+        })
+    )
+
+    async with open_session() as session:
         try:
             while True:
                 if not user_input:
@@ -110,67 +516,16 @@ async def main():
                         console.print("\n[bold yellow]Exiting...[/bold yellow]")
                         return
 
-                with console.status("[bold blue]Generating response...[/bold blue]"):
-                    async with session.post(f'http://localhost:{PORT}/generate', json={'query': user_input}) as response:
-                        data = await response.json()
-                        response_text = data['response']
-
-                commands = []
-                for line in response_text.splitlines():
-                    if line.startswith(tuple(f"{i}." for i in range(1, 10))):
-                        parts = line.split(' - ', 1)
-                        if len(parts) == 2:
-                            cmd, explanation = parts
-                        else:
-                            cmd, explanation = parts[0], ""
-                        commands.append((cmd.strip(), explanation.strip()))
-                
-                commands = commands[:10]  # Limit to 10 commands (0-9)
-                
+                commands = await stream_commands(session, user_input)
+                table_shown = True
+
                 while commands:
-                    table = Table(title="Generated Commands", show_header=True, header_style="bold magenta", expand=True)
-                    table.add_column("#", style="dim", width=4, justify="center")
-                    table.add_column("Command", style="cyan", no_wrap=True, ratio=30)
-                    table.add_column("Explanation", style="green", ratio=70)
-                    
-                    for i, (cmd, explanation) in enumerate(commands):
-                        cmd_parts = cmd.split(None, 1)[1].strip('`*').split()
-                        
-                        colored_cmd = Text()
-                        for j, part in enumerate(cmd_parts):
-                            if j == 0:
-                                colored_cmd.append(part, style="bold cyan")
-                            elif part.startswith('-'):
-                                colored_cmd.append(f" {part}", style="yellow")
-                            else:
-                                colored_cmd.append(f" {part}", style="green")
-                        
-                        table.add_row(str(i), colored_cmd, Text(explanation, style="green"))
-                    
-                    console.print(table)
-
-                    kb = KeyBindings()
-
-                    def handle_input(event):
-                        char = event.data
-                        if char in [str(i) for i in range(10)] + ['n', 'q']:
-                            event.app.exit(result=char)
-
-                    for i in range(10):
-                        kb.add(str(i))(handle_input)
-                    kb.add('n')(handle_input)
-                    kb.add('q')(handle_input)
-
-                    buffer = Buffer()
-                    text_area = TextArea()
-                    application = Application(
-                        layout=Layout(Window(BufferControl(buffer=buffer))),
-                        key_bindings=kb,
-                        full_screen=False,
-                    )
+                    if not table_shown:
+                        console.print(build_commands_table(commands))
+                    table_shown = False
 
                     console.print("Select a command number (0-9), 'n' for a new query, or 'q' to quit: ", end="")
-                    choice = await asyncio.to_thread(application.run)
+                    choice = await asyncio.to_thread(selector.run)
 
                     if choice == 'q':
                         console.print("\n[bold yellow]Exiting...[/bold yellow]")
@@ -181,22 +536,12 @@ async def main():
                     elif choice in [str(i) for i in range(10)]:
                         command_index = int(choice)
                         if 0 <= command_index < len(commands):
-                            command_to_execute = commands[command_index][0].split(None, 1)[1].strip('`*')
+                            command_to_execute = commands[command_index][0]
                             
                             console.print("[italic]Edit the command or press Enter to execute. Use Ctrl+C to cancel.[/italic]")
 
                             colored_command = apply_color_scheme_html(command_to_execute)
-                            
-                            edit_session = PromptSession(
-                                history=InMemoryHistory([command_to_execute]),
-                                auto_suggest=AutoSuggestFromHistory(),
-                                style=Style.from_dict({
-                                    'prompt': '#00FFFF bold',
-                                    'cmd': '#00FFFF bold',
-                                    'arg': '#FFFF00',
-                                    'param': '#00FF00',
-                                })
-                            )
+                            edit_history.append_string(command_to_execute)
 
                             try:
                                 edited_command = await asyncio.to_thread(
@@ -208,14 +553,8 @@ async def main():
                                 console.print("\n[bold yellow]Command execution cancelled.[/bold yellow]")
                                 continue
 
-                            with console.status("[bold green]Executing command...[/bold green]"):
-                                output = await run_command(command_to_execute)
-                            
-                            if output.strip():
-                                console.print(Panel(output, title="Command Output", expand=False, border_style="green"))
-                            else:
-                                console.print("[yellow]Command executed successfully, but produced no output.[/yellow]")
-                            await save_to_history(command_to_execute)
+                            exit_code, latency = await run_command(command_to_execute, tail_lines, limit_lines)
+                            history.record(user_input, command_to_execute, exit_code, latency)
                         else:
                             console.print("[bold red]Invalid selection. Please try again.[/bold red]")
                     else:
@@ -227,6 +566,55 @@ async def main():
             console.print(f"[bold red]An error occurred:[/bold red] {str(e)}")
             if "project" in str(e).lower():
                 console.print("[bold yellow]Please check your PROJECT_ID and ensure it's correctly set in your environment variables.[/bold yellow]")
+        finally:
+            history.close()
+
+def parse_keybinding_args(argv):
+    """Parse the `<query...> --quick` / `--prefetch` calls the shell keybinding makes.
+
+    Returns (flag, query), or None for anything else so argparse handles it.
+    argparse costs a few ms to import, which the keybinding pays on every press.
+    """
+    flags = [arg for arg in argv if arg.startswith('-')]
+    if flags not in (['--quick'], ['--prefetch']):
+        return None
+    return flags[0], " ".join(arg for arg in argv if not arg.startswith('-'))
+
+def main():
+    fast = parse_keybinding_args(sys.argv[1:])
+    if fast is not None:
+        flag, user_input = fast
+        quick, prefetch_only = flag == '--quick', flag == '--prefetch'
+    else:
+        import argparse
+
+        parser = argparse.ArgumentParser(description="AI Coding Assistant CLI")
+        parser.add_argument("query", nargs="*", help="The task or query to generate a command for")
+        parser.add_argument("--quick", action="store_true", help="Get a single best result")
+        parser.add_argument("--prefetch", action="store_true", help="Warm the server cache for a partially typed query")
+        parser.add_argument("--tail", type=int, default=OUTPUT_LINES, metavar="N", help="Show the last N lines of command output")
+        parser.add_argument("--limit", type=int, default=OUTPUT_LIMIT, metavar="N", help="Stop a command after N lines of output")
+        args = parser.parse_args()
+        user_input = " ".join(args.query)
+        quick, prefetch_only = args.quick, args.prefetch
+
+    if prefetch_only:
+        try:
+            prefetch(user_input)
+        except (OSError, ValueError, IndexError):
+            pass  # Best effort, typing must never be interrupted
+        return
+
+    if quick:
+        try:
+            print(quick_suggest(user_input))
+        except (OSError, ValueError, IndexError, KeyError) as e:
+            print(f"opk: quick suggestion failed: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    import asyncio
+    asyncio.run(interactive(user_input, max(args.tail, 1), max(args.limit, 0)))
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
@@ -2,9 +2,23 @@ optionk() {
     local install_path="{INSTALL_PATH}"
     local query="$BUFFER"
     local result=$("$install_path/venv/bin/python" "$install_path/client/opk.py" "$query" --quick)
-    BUFFER="$result"
+    # Keep what was typed if the server could not answer
+    [[ -n "$result" ]] && BUFFER="$result"
     zle end-of-line
 }
 
 zle -N optionk
-bindkey '˚' optionk
\ No newline at end of file
+bindkey '˚' optionk
+
+# Optional: warm the server cache while typing. Set OPK_PREFETCH=1 before sourcing this file.
+if [[ -n "$OPK_PREFETCH" ]]; then
+    _optionk_prefetch() {
+        local install_path="{INSTALL_PATH}"
+        [[ "$BUFFER" == "$_optionk_last_prefetch" ]] && return
+        _optionk_last_prefetch="$BUFFER"
+        (( ${#BUFFER} >= 8 )) || return
+        "$install_path/venv/bin/python" "$install_path/client/opk.py" "$BUFFER" --prefetch &>/dev/null &!
+    }
+    autoload -Uz add-zle-hook-widget
+    add-zle-hook-widget line-pre-redraw _optionk_prefetch
+fi
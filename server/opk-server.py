@@ -4,52 +4,136 @@ import platform
 from functools import lru_cache
 import asyncio
 from aiohttp import web
-from fuzzywuzzy import fuzz
 import signal
+import socket
+import select
+import stat
+import sys
 import configparser
-import google.generativeai as genai
-from vertexai.generative_models import GenerativeModel, GenerationConfig
-from vertexai.generative_models import HarmCategory as VertexHarmCategory
-from vertexai.generative_models import HarmBlockThreshold as VertexHarmBlockThreshold
-from google.generativeai.types import HarmCategory as GoogleHarmCategory
-from google.generativeai.types import HarmBlockThreshold as GoogleHarmBlockThreshold
 import argparse
-import vertexai
 import logging
 import re
+import shlex
+import json
+import time
+import hashlib
+import random
+import heapq
+import math
+import sqlite3
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SOCKET_PATH = '/run/zerocoretwo/server.sock'
 
 # Move these global variables outside of the run_server function
 config = configparser.ConfigParser()
-model = None
-vertex_safetysettings = {
-    VertexHarmCategory.HARM_CATEGORY_HARASSMENT: VertexHarmBlockThreshold.BLOCK_ONLY_HIGH,
-    VertexHarmCategory.HARM_CATEGORY_HATE_SPEECH: VertexHarmBlockThreshold.BLOCK_ONLY_HIGH,
-    VertexHarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: VertexHarmBlockThreshold.BLOCK_ONLY_HIGH,
-    VertexHarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: VertexHarmBlockThreshold.BLOCK_ONLY_HIGH
-}
-
-googleai_safetysettings = {
-    GoogleHarmCategory.HARM_CATEGORY_HARASSMENT: GoogleHarmBlockThreshold.BLOCK_NONE,
-    GoogleHarmCategory.HARM_CATEGORY_HATE_SPEECH: GoogleHarmBlockThreshold.BLOCK_NONE,
-    GoogleHarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: GoogleHarmBlockThreshold.BLOCK_NONE,
-    GoogleHarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: GoogleHarmBlockThreshold.BLOCK_NONE
-}
+backend_pool = None
+executor = None
+quick_executor = None
+scheduler = None
+pending_requests = 0
+response_cache = None
+inflight_requests = {}
+prefetch_tasks = {}
+generate_first_suggestions = {}
+local_index = None
+command_history = None
+prefetch_board = None
+system_info_path = None
+health = {'status': 'starting'}
 
 def create_default_config(config_path):
     config = configparser.ConfigParser()
     config['optionk'] = {
-        'port': '8089'
+        'port': '8089',
+        'max_workers': '8',
+        'max_concurrent_requests': '8',
+        'max_pending_requests': '32',
+        'request_timeout': '30',
+        'startup_check': 'true',
+        'workers': '1'
     }
+    if platform.system() == "Linux":
+        config['optionk']['socket'] = DEFAULT_SOCKET_PATH
     config['vertexai'] = {
         'enabled': 'false',
         'project': 'my-project',
         'location': 'asia-south1',
-        'model': 'gemini-1.5-flash-001'
+        'model': 'gemini-1.5-flash-001',
+        'requests_per_minute': '0',
+        'tokens_per_minute': '0'
     }
     config['google_ai_studio'] = {
         'enabled': 'true',
         'api_key': 'YOUR_API_KEY_HERE',
-        'model': 'gemini-1.5-flash'
+        'model': 'gemini-1.5-flash',
+        'requests_per_minute': '0',
+        'tokens_per_minute': '0'
+    }
+    config['backends'] = {
+        'hedge': 'true',
+        'hedge_quantile': '0.9',
+        'hedge_min_delay': '0.2',
+        'hedge_max_delay': '2.0',
+        'stream_quick': 'true',
+        'burst': '5',
+        'retries': '2',
+        'backoff_base': '1',
+        'backoff_max': '30',
+        'shed': 'batch, prefetch'
+    }
+    config['prompts'] = {
+        'system_instruction': 'true'
+    }
+    config['tokens'] = {
+        'quick': '256',
+        'generate': '1024',
+        'batch_per_query': '100',
+        'batch': '2048'
+    }
+    config['scheduler'] = {
+        'quick': '8',
+        'generate': '4',
+        'batch': '2',
+        'prefetch': '1',
+        'aging': '5'
+    }
+    config['cache'] = {
+        'enabled': 'true',
+        'ttl': '86400',
+        'memory_entries': '1024',
+        'disk_entries': '100000',
+        'fuzzy': 'true',
+        'fuzzy_threshold': '85'
+    }
+    config['local_index'] = {
+        'enabled': 'true',
+        'threshold': '90',
+        'learn': 'false'
+    }
+    config['batch'] = {
+        'concurrency': '4',
+        'pack_size': '0',
+        'max_queries': '500'
+    }
+    config['prefetch'] = {
+        'enabled': 'true',
+        'debounce': '0.4',
+        'min_length': '8'
+    }
+    config['history'] = {
+        'enabled': 'true'
+    }
+    config['metrics'] = {
+        'trace': 'false'
+    }
+    config['client'] = {
+        'output_lines': '20',
+        'output_limit': '0'
     }
     
     os.makedirs(os.path.dirname(config_path), exist_ok=True)
@@ -61,9 +145,20 @@ def create_default_config(config_path):
         content = f.read()
         f.seek(0, 0)
         f.write("# Option-K Configuration File\n\n")
-        f.write("# [optionk]\n# port: The port number for the Option-K server\n\n")
-        f.write("# [vertexai]\n# enabled: Set to true to use Vertex AI\n# project: Your Google Cloud project ID\n# location: The location of your Vertex AI resources\n# model: The Vertex AI model to use\n\n")
-        f.write("# [google_ai_studio]\n# enabled: Set to true to use Google AI Studio\n# api_key: Your Google AI Studio API key\n# model: The Google AI Studio model to use\n\n")
+        f.write("# [optionk]\n# port: The port number for the Option-K server\n# max_workers: Worker threads used for blocking model calls, raised to fit max_concurrent_requests and hedged calls; quick suggestions have their own threads\n# max_concurrent_requests: Model calls made at the same time, not counting quick suggestions\n# max_pending_requests: Requests of one priority class allowed in the server before answering 503\n# request_timeout: Seconds before a model call is abandoned with 504\n# startup_check: Test the AI backend in the background after startup, see /health\n# workers: Server processes sharing the port and socket; above 1, SIGHUP reloads this file without downtime\n# socket: Unix socket the server also listens on (Linux default: /run/zerocoretwo/server.sock)\n\n")
+        f.write("# [vertexai]\n# enabled: Set to true to use Vertex AI\n# project: Your Google Cloud project ID\n# location: The location of your Vertex AI resources\n# model: The Vertex AI model to use, or several separated by commas\n# requests_per_minute, tokens_per_minute: Quota of each model, calls are paced to stay within it (0 = no limit)\n\n")
+        f.write("# [google_ai_studio]\n# enabled: Set to true to use Google AI Studio\n# api_key: Your Google AI Studio API key\n# model: The Google AI Studio model to use, or several separated by commas\n# requests_per_minute, tokens_per_minute: Quota of each model, calls are paced to stay within it (0 = no limit)\n\n")
+        f.write("# [backends]\n# hedge: Also ask the next backend when the fastest one is slow to answer\n# hedge_quantile: Latency quantile (0-1) of a backend after which its calls are hedged\n# hedge_min_delay: Never hedge sooner than this many seconds\n# hedge_max_delay: Always hedge after this many seconds\n# stream_quick: Stream quick suggestions and stop at the first complete command\n# burst: Seconds of quota that may be spent at once after an idle spell\n# retries: Extra rounds over all backends when every one answers with a quota error\n# backoff_base, backoff_max: Pause in seconds after a quota error, doubled per error in a row up to backoff_max\n# shed: Request classes answered with 429 at once instead of waiting for quota\n\n")
+        f.write("# [prompts]\n# system_instruction: Send the fixed part of each prompt as the model's system instruction\n\n")
+        f.write("# [tokens]\n# quick: Output token limit for a quick suggestion\n# generate: Output token limit for a list of suggestions\n# batch_per_query: Output tokens allowed per query in a packed batch call\n# batch: Output token limit for one packed batch call\n\n")
+        f.write("# [scheduler]\n# quick, generate, batch, prefetch: Model calls each class may make at the same time (highest priority first)\n# aging: Seconds of waiting after which a queued call moves up one priority class\n\n")
+        f.write("# [cache]\n# enabled: Set to false to always ask the model\n# ttl: Seconds a cached answer stays valid\n# memory_entries: Answers kept in memory\n# disk_entries: Answers kept in cache.db next to this file\n# fuzzy: Serve answers to near-identical queries from the cache\n# fuzzy_threshold: Similarity (0-100) a cached query needs to be reused\n\n")
+        f.write("# [local_index]\n# enabled: Answer common queries from the built-in command index without calling the model\n# threshold: Similarity (0-100) a known query needs to be answered locally\n# learn: Add quick suggestions from the model to commands.tsv next to this file\n\n")
+        f.write("# [batch]\n# concurrency: Model calls a /batch request makes at the same time\n# pack_size: Quick queries answered by a single model call (0 or 1 disables packing)\n# max_queries: Largest batch accepted\n\n")
+        f.write("# [prefetch]\n# enabled: Warm the cache from partially typed queries sent to /prefetch\n# debounce: Seconds of typing pause before a prefetch is sent upstream\n# min_length: Shortest partial query worth prefetching\n\n")
+        f.write("# [history]\n# enabled: Answer quick queries with the command you picked for them before (history.db next to this file)\n\n")
+        f.write("# [metrics]\n# trace: Log the time each request spent in every stage as one JSON line\n\n")
+        f.write("# [client]\n# output_lines: Lines of command output kept on screen while a command runs\n# output_limit: Stop a command after this many lines of output (0 = never)\n\n")
         f.write(content)
 
 def get_config_path(custom_path=None):
@@ -76,8 +171,564 @@ def get_config_path(custom_path=None):
         config_path = os.path.expanduser('~/.config/optionk/config.ini')
     return config_path
 
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """Counters, gauges and histograms with labels, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # Token counts are recorded from worker threads
+        self.kinds = {}
+        self.descriptions = {}
+        self.series = {}
+
+    def describe(self, name, kind, description):
+        self.kinds[name] = kind
+        self.descriptions[name] = description
+        self.series[name] = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.series[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            if key not in series:
+                series[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            buckets, _, _ = histogram = series[key]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, series in self.series.items():
+                kind = self.kinds[name]
+                lines.append(f"# HELP {name} {self.descriptions[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    if kind != 'histogram':
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    buckets, total, count = value
+                    cumulative = 0
+                    for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                        cumulative += bucket
+                        lines.append(f"{name}_bucket{format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {total}")
+                    lines.append(f"{name}_count{format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(key):
+    if not key:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in key)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(key, escaped)) + "}"
+
+metrics = Metrics()
+metrics.describe('opk_requests_total', 'counter', "HTTP requests by endpoint and status")
+metrics.describe('opk_request_seconds', 'histogram', "HTTP request latency by endpoint")
+metrics.describe('opk_stage_seconds', 'histogram', "Time spent in each stage of a request")
+metrics.describe('opk_upstream_seconds', 'histogram', "Model call latency by backend")
+metrics.describe('opk_upstream_first_chunk_seconds', 'histogram', "Time to the first streamed chunk by backend")
+metrics.describe('opk_upstream_tokens_total', 'counter', "Tokens sent to and received from each backend")
+metrics.describe('opk_upstream_errors_total', 'counter', "Failed model calls by backend")
+metrics.describe('opk_rate_limited_total', 'counter', "Quota errors returned by each backend")
+metrics.describe('opk_rate_limit_wait_seconds', 'histogram', "Time model calls waited for backend quota")
+metrics.describe('opk_shed_total', 'counter', "Requests turned away because every backend was out of quota")
+metrics.describe('opk_hedged_calls_total', 'counter', "Model calls also sent to a second backend")
+metrics.describe('opk_cache_lookups_total', 'counter', "Response cache lookups by the tier that answered")
+metrics.describe('opk_quick_early_stops_total', 'counter', "Quick suggestions taken before the model finished its answer")
+metrics.describe('opk_answers_total', 'counter', "Answers by kind and where they came from")
+metrics.describe('opk_pending_requests', 'gauge', "Requests being served or waiting for a slot")
+metrics.describe('opk_inflight_upstream', 'gauge', "Distinct model calls in flight")
+metrics.describe('opk_prefetch_tasks', 'gauge', "Scheduled prefetches")
+metrics.describe('opk_queue_depth', 'gauge', "Model calls waiting for a slot by priority class")
+metrics.describe('opk_upstream_running', 'gauge', "Model calls holding a slot by priority class")
+metrics.describe('opk_queue_wait_seconds', 'histogram', "Time model calls waited for a slot by priority class")
+
+# Set by the instrument middleware so stages can be attributed to the request they ran for
+request_trace = contextvars.ContextVar('request_trace', default=None)
+
+def record_stage(name, elapsed):
+    trace = request_trace.get()
+    metrics.observe('opk_stage_seconds', elapsed, endpoint=trace['endpoint'] if trace else 'background', stage=name)
+    if trace is not None:
+        trace['stages'][name] = trace['stages'].get(name, 0) + elapsed
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+QUERY_TOKEN_PATTERN = re.compile(r"[\w./*~-]+")
+QUOTED_PATTERN = re.compile(r"([\"'])(.*?)\1")
+QUERY_STOPWORDS = frozenset(["a", "an", "the", "all", "my", "me", "i", "to", "of", "for", "in", "on", "and", "please", "how", "do", "can", "you"])
+
+def query_terms(query):
+    """Split a query into normalized tokens plus literals that must match exactly."""
+    lowered = query.lower()
+    tokens = set()
+    leading = None
+    for token in QUERY_TOKEN_PATTERN.findall(lowered):
+        if token in QUERY_STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        leading = leading or token
+        tokens.add(token)
+    # Numbers and quoted text change the command, so "100MB" never matches "10MB".
+    # So does the leading verb, which is common enough to weigh next to nothing:
+    # "list stopped containers" must never get the answer to "delete stopped containers".
+    literals = {token for token in tokens if any(ch.isdigit() for ch in token)}
+    literals.update(match[1] for match in QUOTED_PATTERN.findall(lowered))
+    if leading is not None:
+        literals.add(leading)
+    return frozenset(tokens), frozenset(literals)
+
+class QueryIndex:
+    """Inverted token index over answered queries for near-duplicate lookups."""
+
+    def __init__(self, threshold, max_scan=2000, max_candidates=32):
+        self.threshold = threshold
+        self.max_scan = max_scan
+        self.max_candidates = max_candidates
+        self.entries = []
+        self.postings = {}
+        self.signatures = {}
+        self.ids = {}
+        self.dead = 0
+
+    def add(self, namespace, query, key):
+        if key in self.ids:
+            return
+        tokens, literals = query_terms(query)
+        if not tokens:
+            return
+        entry_id = len(self.entries)
+        self.entries.append((namespace, key, tokens, literals))
+        self.ids[key] = entry_id
+        self.signatures[(namespace, tokens, literals)] = entry_id
+        for token in tokens:
+            self.postings.setdefault((namespace, token), []).append(entry_id)
+
+    def remove(self, key):
+        entry_id = self.ids.pop(key, None)
+        if entry_id is None:
+            return
+        self.entries[entry_id] = None
+        self.dead += 1
+        if self.dead > len(self.entries) // 2:
+            self._rebuild()
+
+    def lookup(self, namespace, query):
+        tokens, literals = query_terms(query)
+        if not tokens:
+            return None
+        entry_id = self.signatures.get((namespace, tokens, literals))
+        if entry_id is not None and self.entries[entry_id] is not None:
+            return self.entries[entry_id][1]
+
+        # Rarest tokens first; very common tokens are only scanned when nothing rarer matched
+        postings = sorted((self.postings.get((namespace, token), ()) for token in tokens), key=len)
+        overlap = {}
+        for ids in postings:
+            if overlap and len(ids) > self.max_scan:
+                break
+            for candidate in ids[-self.max_scan:]:
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+        if not overlap:
+            return None
+
+        total = len(self.entries) - self.dead
+        weights = {}
+        def weight(token):
+            if token not in weights:
+                weights[token] = math.log(1 + total / (1 + len(self.postings.get((namespace, token), ()))))
+            return weights[token]
+
+        query_weight = sum(weight(token) for token in tokens)
+        best_key, best_score = None, 0.0
+        for candidate in heapq.nlargest(self.max_candidates, overlap, key=overlap.get):
+            entry = self.entries[candidate]
+            if entry is None or entry[3] != literals:
+                continue
+            shared = sum(weight(token) for token in tokens & entry[2])
+            score = 200.0 * shared / (query_weight + sum(weight(token) for token in entry[2]))
+            if score > best_score:
+                best_key, best_score = entry[1], score
+        return best_key if best_score >= self.threshold else None
+
+    def _rebuild(self):
+        live = [entry for entry in self.entries if entry is not None]
+        self.entries, self.postings, self.signatures, self.ids, self.dead = [], {}, {}, {}, 0
+        for namespace, key, tokens, literals in live:
+            entry_id = len(self.entries)
+            self.entries.append((namespace, key, tokens, literals))
+            self.ids[key] = entry_id
+            self.signatures[(namespace, tokens, literals)] = entry_id
+            for token in tokens:
+                self.postings.setdefault((namespace, token), []).append(entry_id)
+
+class ResponseCache:
+    """In-memory LRU in front of a SQLite store that survives restarts.
+
+    Worker processes share the SQLite store. With shared=True, answers other
+    workers stored are also added to the fuzzy index before each fuzzy lookup.
+    """
+
+    def __init__(self, path, ttl, memory_entries, disk_entries, index=None, shared=False):
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.index = index
+        self.shared = shared
+        self.memory = OrderedDict()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Worker processes open the store at the same time, only one may create or migrate it
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(responses)")}
+        for column in ('namespace', 'query'):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE responses ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.execute("COMMIT")
+        self.disk_count = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self.synced = self.db.execute("SELECT COALESCE(MAX(rowid), 0) FROM responses").fetchone()[0]
+        if self.index is not None:
+            rows = self.db.execute(
+                "SELECT namespace, query, key FROM responses WHERE created > ? AND query != ''",
+                (time.time() - ttl,)
+            )
+            for namespace, query, key in rows:
+                self.index.add(namespace, query, key)
+
+    def get(self, namespace, query, fuzzy=False):
+        key = cache_key(namespace, query)
+        tier = 'memory' if key in self.memory else 'disk'
+        value = self._get(key)
+        if value is not None:
+            metrics.inc('opk_cache_lookups_total', tier=tier)
+            return value
+        if fuzzy and self.index is not None:
+            if self.shared:
+                self._sync_index()
+            similar_key = self.index.lookup(namespace, query)
+            if similar_key is not None and similar_key != key:
+                value = self._get(similar_key)
+                if value is not None:
+                    metrics.inc('opk_cache_lookups_total', tier='fuzzy')
+                    return value
+                self.index.remove(similar_key)
+        metrics.inc('opk_cache_lookups_total', tier='miss')
+        return None
+
+    def peek(self, namespace, query):
+        """An exact get() that leaves the lookup metrics alone, for a second look at another namespace."""
+        return self._get(cache_key(namespace, query))
+
+    def put(self, namespace, query, value):
+        key = cache_key(namespace, query)
+        now = time.time()
+        self._remember(key, value, now)
+        # Refreshing an answer replaces its row, only new rows count towards disk_entries
+        exists = self.db.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, created, accessed, namespace, query) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, value, now, now, namespace, query)
+        )
+        if self.index is not None:
+            self.index.add(namespace, query, key)
+        if not exists:
+            self.disk_count += 1
+        if self.disk_count > self.disk_entries:
+            # Evict in batches so the common put stays a single insert
+            excess = self.disk_count - self.disk_entries + self.disk_entries // 10
+            keys = [row[0] for row in self.db.execute(
+                "SELECT key FROM responses ORDER BY accessed LIMIT ?", (excess,)
+            )]
+            self.db.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key in keys])
+            if self.index is not None:
+                for key in keys:
+                    self.index.remove(key)
+            self.disk_count = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _sync_index(self):
+        # Rows are appended with increasing rowids, replaced ones included
+        rows = self.db.execute(
+            "SELECT rowid, namespace, query, key FROM responses WHERE rowid > ? AND query != ''",
+            (self.synced,)
+        ).fetchall()
+        for rowid, namespace, query, key in rows:
+            self.index.add(namespace, query, key)
+            self.synced = max(self.synced, rowid)
+
+    def _get(self, key):
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None:
+            value, created = entry
+            if now - created < self.ttl:
+                self.memory.move_to_end(key)
+                return value
+            del self.memory[key]
+
+        row = self.db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, created = row
+        if now - created >= self.ttl:
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            if self.index is not None:
+                self.index.remove(key)
+            return None
+        self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self._remember(key, value, created)
+        return value
+
+    def _remember(self, key, value, created):
+        self.memory[key] = (value, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+def init_cache(config_path, shared=False):
+    global response_cache
+    if not config.getboolean('cache', 'enabled', fallback=True):
+        response_cache = None
+        return
+    index = None
+    if config.getboolean('cache', 'fuzzy', fallback=True):
+        index = QueryIndex(threshold=config.getfloat('cache', 'fuzzy_threshold', fallback=85))
+    response_cache = ResponseCache(
+        os.path.join(os.path.dirname(config_path), 'cache.db'),
+        ttl=config.getfloat('cache', 'ttl', fallback=86400),
+        memory_entries=config.getint('cache', 'memory_entries', fallback=1024),
+        disk_entries=config.getint('cache', 'disk_entries', fallback=100000),
+        index=index,
+        shared=shared
+    )
+
+def current_platform_tag():
+    system = platform.system()
+    return {'Darwin': 'macos', 'Linux': 'linux'}.get(system, system.lower())
+
+class LocalCommandIndex:
+    """Known commands for common queries, answered without calling the model.
+
+    Entries are TSV rows of platform, query, command and explanation. Rows
+    that share a query form its ranked list of suggestions. Learned rows add a
+    fifth column, 'quick': a single command is no list for /generate, so those
+    rows only answer quick suggestions.
+    """
+
+    def __init__(self, threshold, learned_path=None):
+        self.queries = QueryIndex(threshold)
+        self.commands = {}
+        self.learned_path = learned_path
+
+    def load(self, path, kind=""):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t') + ["", ""]
+                if fields[2]:
+                    self._add(fields[0], fields[1], fields[2], fields[3], fields[4] or kind)
+
+    def lookup(self, query, quick=False):
+        for tag in (current_platform_tag(), 'any'):
+            for namespace in (tag, f"{tag}/quick") if quick else (tag,):
+                key = self.queries.lookup(namespace, query)
+                if key is not None:
+                    return self.commands[key]
+        return None
+
+    def learn(self, query, command, explanation=""):
+        """Remember a quick suggestion the model gave for query."""
+        if self.learned_path is None or '\n' in command or '\t' in command + query + explanation:
+            return
+        tag = current_platform_tag()
+        if self._add(tag, query, command, explanation, 'quick'):
+            with open(self.learned_path, 'a', encoding='utf-8') as f:
+                f.write(f"{tag}\t{query}\t{command}\t{explanation}\tquick\n")
+
+    def _add(self, tag, query, command, explanation, kind=""):
+        namespace = f"{tag}/quick" if kind == 'quick' else tag
+        key = f"{namespace}\n{normalize_query(query).lower()}"
+        commands = self.commands.setdefault(key, [])
+        if any(known == command for known, _ in commands):
+            return False
+        commands.append((command, explanation))
+        self.queries.add(namespace, query, key)
+        return True
+
+def init_local_index(config_path):
+    global local_index
+    if not config.getboolean('local_index', 'enabled', fallback=True):
+        local_index = None
+        return
+    learned_path = os.path.join(os.path.dirname(config_path), 'commands.tsv')
+    local_index = LocalCommandIndex(
+        threshold=config.getfloat('local_index', 'threshold', fallback=90),
+        learned_path=learned_path if config.getboolean('local_index', 'learn', fallback=False) else None
+    )
+    builtin_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'commands.tsv')
+    if os.path.exists(builtin_path):
+        local_index.load(builtin_path)
+    if os.path.exists(learned_path):
+        # Only quick suggestions have ever been learned, older files just lack the column
+        local_index.load(learned_path, kind='quick')
+
+class CommandHistory:
+    """Read-only view of the client's history.db: the commands picked for past queries."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def _query(self, sql, params):
+        try:
+            if self.db is None:
+                # The client creates the file on first use, so keep checking until it exists
+                if not os.path.exists(self.path):
+                    return None
+                self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            row = self.db.execute(sql, params).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"History lookup failed: {str(e)}")
+            return None
+        return row[0] if row else None
+
+    def answer(self, query):
+        """The most frecent command picked for this query that has worked at least once."""
+        return self._query(
+            "SELECT command FROM queries WHERE query = ? AND failures < uses ORDER BY score DESC LIMIT 1",
+            (" ".join(query.lower().split()),)
+        )
+
+    def complete(self, prefix):
+        """The most frecent past query starting with prefix."""
+        prefix = " ".join(prefix.lower().split())
+        return self._query(
+            "SELECT query FROM queries WHERE query >= ? AND query < ? AND failures < uses ORDER BY score DESC LIMIT 1",
+            (prefix, prefix + "\U0010ffff")
+        )
+
+def init_history(config_path):
+    global command_history
+    if config.getboolean('history', 'enabled', fallback=True):
+        command_history = CommandHistory(os.path.join(os.path.dirname(config_path), 'history.db'))
+    else:
+        command_history = None
+
+def history_quick_answer(query):
+    if command_history is None or is_commit_message_query(query):
+        return None
+    return command_history.answer(query)
+
+def local_quick_answer(query):
+    # A commit message has to be written for this query, no stored command fits
+    if local_index is None or is_commit_message_query(query):
+        return None
+    commands = local_index.lookup(query, quick=True)
+    return commands[0][0] if commands else None
+
+def local_generate_answer(query):
+    if local_index is None:
+        return None
+    commands = local_index.lookup(query)
+    if not commands:
+        return None
+    return "\n".join(
+        f"{i}. {command} - {explanation}" if explanation else f"{i}. {command}"
+        for i, (command, explanation) in enumerate(commands)
+    )
+
+def get_model_name():
+    # Any backend in the pool may answer, so cached answers are shared between them
+    if backend_pool is None:
+        return ''
+    return ",".join(backend.name for backend in backend_pool.backends)
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+def cache_namespace(kind, system_query, system_info):
+    # Only answers produced by the same prompt, model and system are interchangeable
+    material = json.dumps([kind, get_model_name(), system_info, system_query])
+    return hashlib.sha256(material.encode()).hexdigest()
+
+def cache_key(namespace, query):
+    return hashlib.sha256(f"{namespace}\n{query}".encode()).hexdigest()
+
+def cache_get(namespace, query, use_cache=True, fuzzy=True):
+    if response_cache is None or not use_cache:
+        return None
+    return response_cache.get(namespace, query, fuzzy)
+
+def cache_peek(namespace, query):
+    return response_cache.peek(namespace, query) if response_cache is not None else None
+
+def cache_put(namespace, query, value):
+    if response_cache is not None:
+        response_cache.put(namespace, query, value)
+
+def system_fingerprint():
+    # Changes whenever the kernel or the OS release files change, i.e. after an upgrade
+    uname = platform.uname()
+    parts = [uname.system, uname.release, uname.version, uname.machine]
+    for path in ('/etc/os-release', '/etc/lsb-release', '/System/Library/CoreServices/SystemVersion.plist'):
+        try:
+            parts.append(os.stat(path).st_mtime)
+        except OSError:
+            pass
+    return parts
+
 @lru_cache(maxsize=1)
 def get_system_info():
+    fingerprint = system_fingerprint()
+    if system_info_path:
+        try:
+            with open(system_info_path) as f:
+                cached = json.load(f)
+            if cached['fingerprint'] == fingerprint:
+                return cached['info']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    info = probe_system_info()
+    if system_info_path:
+        try:
+            with open(system_info_path, 'w') as f:
+                json.dump({'fingerprint': fingerprint, 'info': info}, f)
+        except OSError:
+            pass
+    return info
+
+def probe_system_info():
     system = platform.system()
     machine = platform.machine()
     if system == "Darwin":
@@ -96,172 +747,1858 @@ def get_system_info():
     
     return f"{os_name} {version} ({machine})"
 
-async def generate_response_stream(query, command_type, system_info):
-    is_git_query = is_git_related_query(query)
-    
-    if is_git_query:
-        system_query = f"""Machine-readable output. You are a Git expert providing git commands that match the query.
-        Provide git commands specific to this system.
-        Rank suggestions by relevance.
-        Explain what each git command does and how it works.
-        Output as a numbered list (starts with 0) in the format: <git command> - <explanation>.
-        """
-    else:
-        system_query = f"""Machine-readable output. You are a CLI expert providing {command_type} commands that match the query.
-        The user's system is: {system_info}
-        Provide commands specific to this system.
-        Rank suggestions by relevance.
-        Explain what each command does and how it works.
-        Output as a numbered list (starts with 0) in the format: <command> - <explanation>."""
-    
-    full_query = f"{system_query}\n\nquery: {query}\n\nProvide up to 9 commands."
-    
-    if config.getboolean('vertexai', 'enabled', fallback=False):
-        response = model.generate_content(
-            contents=full_query,
-            generation_config=GenerationConfig(
-                max_output_tokens=1024,
-                temperature=0,
-                top_p=1,
-                top_k=1
-            ),
-            safety_settings=vertex_safetysettings,
-            stream=True
-        )
-        
-        full_response = ""
-        for chunk in response:
-            if chunk.text:
-                full_response += chunk.text
-    else:  # Google AI Studio
-        response = model.generate_content(
-            full_query,
-            generation_config=genai.GenerationConfig(
-                max_output_tokens=1024,
+class QuotaExceeded(Exception):
+    """Every backend is out of quota; retry_after is a hint in seconds, or None."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+RETRY_HINT_PATTERN = re.compile(r"retry(?:[ _-]?(?:in|after|delay))?\W*(?:seconds:\s*)?(\d+(?:\.\d+)?)", re.IGNORECASE)
+
+def is_quota_error(error):
+    # google.api_core raises ResourceExhausted (code 429) for both SDKs, this avoids importing it
+    return (isinstance(error, QuotaExceeded) or getattr(error, 'code', None) == 429
+            or type(error).__name__ in ('ResourceExhausted', 'TooManyRequests'))
+
+def retry_after_hint(error):
+    """Seconds the upstream asked us to wait before retrying, if it said."""
+    if getattr(error, 'retry_after', None) is not None:
+        return error.retry_after
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers['Retry-After'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    # Gemini puts it in the message: "Please retry in 14.2s" or "retry_delay { seconds: 14 }"
+    match = RETRY_HINT_PATTERN.search(str(error))
+    return float(match.group(1)) if match else None
+
+def estimate_tokens(system_query, user_query, max_output_tokens):
+    # About four characters per token. The unused output share is given back once the real usage is known.
+    return (len(system_query or "") + len(user_query)) // 4 + max_output_tokens
+
+class RateLimiter:
+    """Token buckets for one backend's requests and tokens per minute quota.
+
+    A call reserves its share up front and sleeps until the buckets cover it,
+    so concurrent calls are spread evenly at the quota instead of bursting
+    into 429s. After a quota error the backend is paused for the retry hint of
+    the error, or with jittered exponential backoff when there is none.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, burst=5.0, backoff_base=1.0, backoff_max=30.0):
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60
+        self.request_capacity = max(self.request_rate * burst, 1)
+        self.token_capacity = self.token_rate * burst
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failures = 0
+        self.paused_until = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()  # Usage is settled from the worker threads
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.requests + elapsed * self.request_rate, self.request_capacity)
+        self.tokens = min(self.tokens + elapsed * self.token_rate, self.token_capacity)
+
+    def _cost(self, tokens):
+        # A call larger than the whole bucket would otherwise never be allowed
+        return min(tokens, self.token_capacity)
+
+    def _delay(self, tokens, now):
+        self._refill(now)
+        delay = self.paused_until - now
+        if self.request_rate:
+            delay = max(delay, (1 - self.requests) / self.request_rate)
+        if self.token_rate:
+            delay = max(delay, (self._cost(tokens) - self.tokens) / self.token_rate)
+        return max(delay, 0.0)
+
+    def delay(self, tokens):
+        """Seconds a call of `tokens` would wait if it was made now."""
+        with self.lock:
+            return self._delay(tokens, time.monotonic())
+
+    def reserve(self, tokens):
+        """Take a call's share of the quota and return how long to wait before making it."""
+        with self.lock:
+            now = time.monotonic()
+            delay = self._delay(tokens, now)
+            if now < self.paused_until:
+                # Spread out the calls waiting for a pause to end, or they hit the upstream all at once again
+                delay += random.uniform(0, self.paused_until - now)
+            if self.request_rate:
+                self.requests -= 1
+            if self.token_rate:
+                self.tokens -= self._cost(tokens)
+            return delay
+
+    def refund(self, tokens):
+        with self.lock:
+            if self.request_rate:
+                self.requests = min(self.requests + 1, self.request_capacity)
+            if self.token_rate:
+                self.tokens = min(self.tokens + self._cost(tokens), self.token_capacity)
+
+    def settle(self, reserved, used):
+        if used is None or not self.token_rate:
+            return
+        with self.lock:
+            self.tokens = min(self.tokens + self._cost(reserved) - used, self.token_capacity)
+
+    def succeeded(self):
+        self.failures = 0
+
+    def backoff(self, retry_after=None):
+        """Pause the backend after a quota error; returns the pause, or None if it was already paused."""
+        with self.lock:
+            now = time.monotonic()
+            if retry_after is None:
+                if now < self.paused_until:
+                    # More 429s from calls made before the pause, they don't make it longer
+                    return None
+                self.failures += 1
+                # Half fixed, half random, so the callers that hit the same 429 don't all retry together
+                ceiling = min(self.backoff_base * 2 ** (self.failures - 1), self.backoff_max)
+                retry_after = ceiling / 2 + random.uniform(0, ceiling / 2)
+            self.paused_until = max(self.paused_until, now + retry_after)
+            # Whatever our estimate said, the upstream quota is spent
+            self._refill(now)
+            self.requests = min(self.requests, 0)
+            self.tokens = min(self.tokens, 0)
+            return retry_after
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'requests_left': round(self.requests, 1) if self.request_rate else None,
+                'tokens_left': round(self.tokens) if self.token_rate else None,
+                'paused': round(max(self.paused_until - now, 0), 1)
+            }
+
+class Backend:
+    """One provider and model, with rolling latency and error statistics.
+
+    make_model(system_instruction) builds the SDK model. With system_instruction
+    on, one model is kept per distinct system prompt and only the query is sent
+    as content; otherwise the system prompt is prepended to the query.
+    """
+
+    def __init__(self, name, make_model, generation_config, safety_settings, wrap_contents=False,
+                 system_instruction=True, window=100, limiter=None):
+        self.name = name
+        self.make_model = make_model
+        self.generation_config = generation_config
+        self.safety_settings = safety_settings
+        self.wrap_contents = wrap_contents
+        self.system_instruction = system_instruction
+        self.models = OrderedDict()
+        self.models_lock = threading.Lock()  # Models are looked up from the worker threads
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.limiter = limiter or RateLimiter()
+
+    def model_for(self, system_instruction):
+        with self.models_lock:
+            model = self.models.get(system_instruction)
+            if model is None:
+                model = self.models[system_instruction] = self.make_model(system_instruction)
+                # There is one system prompt per query family and system, so this rarely evicts
+                if len(self.models) > 64:
+                    self.models.popitem(last=False)
+            else:
+                self.models.move_to_end(system_instruction)
+            return model
+
+    def generate(self, system_query, user_query, max_output_tokens, stream=False):
+        # Blocking SDK call, only ever run on the worker pool
+        if self.system_instruction or not system_query:
+            model, contents = self.model_for(system_query), user_query
+        else:
+            model, contents = self.model_for(None), f"{system_query}\n\n{user_query}"
+        return model.generate_content(
+            [contents] if self.wrap_contents else contents,
+            generation_config=self.generation_config(
+                max_output_tokens=max_output_tokens,
                 temperature=0,
                 top_p=1,
                 top_k=1
             ),
-            safety_settings=googleai_safetysettings,
-            stream=True
+            safety_settings=self.safety_settings,
+            stream=stream
         )
-        
-        full_response = ""
-        for chunk in response:
-            full_response += chunk.text
-    
-    return full_response
 
-def is_git_related_query(query):
-    query = query.lower()
-    git_terms = ["git", "commit", "branch", "merge", "pull", "push", "rebase", "stash", "checkout", "clone"]
-    url_pattern = re.compile(r'https?://\S+|www\.\S+')
+    def generate_text(self, system_query, user_query, max_output_tokens, reserved=0):
+        response = self.generate(system_query, user_query, max_output_tokens)
+        self.limiter.settle(reserved, self.count_tokens(response))
+        return response.text
 
-    # Check if any git term is mentioned (allowing for misspellings)
-    contains_git_term = any(fuzz.partial_ratio(term, query) > 85 for term in git_terms)
+    def count_tokens(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return None
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+        metrics.inc('opk_upstream_tokens_total', prompt_tokens, backend=self.name, kind='input')
+        metrics.inc('opk_upstream_tokens_total', output_tokens, backend=self.name, kind='output')
+        return prompt_tokens + output_tokens
 
-    # Check if 'git' is part of a URL
-    urls = url_pattern.findall(query)
-    git_in_url = any('git' in url.lower() for url in urls)
+    def record(self, elapsed, ok):
+        self.outcomes.append(ok)
+        if not ok:
+            metrics.inc('opk_upstream_errors_total', backend=self.name)
+        # Failures return early or time out, either way their latency says nothing about the backend
+        if ok and elapsed is not None:
+            self.latencies.append(elapsed)
 
-    # Check for common download commands
-    download_commands = ["curl", "wget"]
-    looks_like_download = any(command in query for command in download_commands)
+    def quantile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
 
-    # Check for context (e.g., "How to use git")
-    git_context = re.search(r'\b(use|using|with|in)\s+git\b', query) is not None
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
 
-    return (contains_git_term or git_context) and not (git_in_url or looks_like_download)
+    def expected_latency(self):
+        # Unmeasured backends rank last, so the configured order decides until there is data
+        median = self.quantile(0.5)
+        if median is None:
+            return math.inf
+        return median / max(1 - self.error_rate(), 0.05)
 
-async def get_single_best_result(query, command_type, system_info):
-    is_git_query = is_git_related_query(query)
-    is_commit_message = "commit" in query and "message" in query
-    
-    if is_git_query:
-        system_query = f"""Machine-readable output. 
-        Output with JUST the command to run directly in the command line.
-        You are a Git expert providing the single best git command that matches the query.
-        """
-        if is_commit_message:
-            system_query += """
-            For commit messages:
-            1. Rewrite the commit message to meet Conventional Commits Specification.
-            2. Use the block-style commit message format with a single pair of quotes.
-            3. Separate the title from the body with a blank line.
-            4. Wrap the body text at approximately 72 characters.
-            5. Output just the git commit command.
-            """
-        else:
-            system_query += "Output JUST the command to run directly in the command line."
+    def stats(self):
+        p50, p99 = self.quantile(0.5), self.quantile(0.99)
+        return {
+            'backend': self.name,
+            'p50': round(p50, 3) if p50 is not None else None,
+            'p99': round(p99, 3) if p99 is not None else None,
+            'error_rate': round(self.error_rate(), 3),
+            'calls': len(self.outcomes),
+            'quota': self.limiter.stats()
+        }
+
+class BackendPool:
+    """Route model calls to the fastest healthy backend and hedge the slow ones.
+
+    A call goes to the backend with quota left and the lowest expected latency.
+    If it has not answered after that backend's hedge_quantile latency (clamped
+    to hedge_min_delay..hedge_max_delay), the next backend is asked as well and
+    the first answer wins. A backend that fails is replaced by the next one at
+    once. When every backend answers with a quota error, the pool waits out
+    their backoff and tries again, up to `retries` more times.
+    """
+
+    def __init__(self, backends, hedge=True, hedge_quantile=0.9, hedge_min_delay=0.2, hedge_max_delay=2.0,
+                 retries=2, shed=()):
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.retries = retries
+        self.shed = shed
+
+    def ranked(self, tokens=0):
+        # sorted() is stable, so ties keep the configured order
+        return sorted(self.backends, key=lambda backend: (backend.limiter.delay(tokens), backend.expected_latency()))
+
+    def admit(self, tokens):
+        """Turn low-priority calls away at once when no backend has quota for them."""
+        priority_class = current_priority()
+        if priority_class not in self.shed:
+            return
+        delay = min(backend.limiter.delay(tokens) for backend in self.backends)
+        if delay > 0:
+            metrics.inc('opk_shed_total', priority=priority_class)
+            raise QuotaExceeded("Rate limit reached, try again later", retry_after=delay)
+
+    async def throttle(self, backend, tokens):
+        delay = backend.limiter.reserve(tokens)
+        if delay <= 0:
+            return
+        metrics.observe('opk_rate_limit_wait_seconds', delay, backend=backend.name)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            backend.limiter.refund(tokens)
+            raise
+
+    def quota_error(self, backend, error):
+        metrics.inc('opk_rate_limited_total', backend=backend.name)
+        pause = backend.limiter.backoff(retry_after_hint(error))
+        if pause is not None:
+            logging.warning(f"Backend {backend.name} is out of quota, pausing it for {pause:.1f}s")
+
+    def hedge_delay(self, backend):
+        delay = backend.quantile(self.hedge_quantile)
+        if delay is None:
+            return self.hedge_max_delay
+        return min(max(delay, self.hedge_min_delay), self.hedge_max_delay)
+
+    def submit(self, backend, system_query, user_query, max_output_tokens, reserved=0):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+
+        def finished(future):
+            # Also runs for calls that lost a hedge, so every backend keeps getting measured
+            ok = not future.cancelled() and future.exception() is None
+            if ok:
+                metrics.observe('opk_upstream_seconds', time.perf_counter() - started, backend=backend.name)
+                backend.limiter.succeeded()
+            try:
+                loop.call_soon_threadsafe(backend.record, time.perf_counter() - started, ok)
+            except RuntimeError:
+                pass  # The loop closed while a hedged call was still running
+
+        future = model_executor().submit(backend.generate_text, system_query, user_query, max_output_tokens, reserved)
+        future.add_done_callback(finished)
+        return asyncio.wrap_future(future)
+
+    async def call(self, system_query, user_query, max_output_tokens):
+        tokens = estimate_tokens(system_query, user_query, max_output_tokens)
+        self.admit(tokens)
+        for _ in range(self.retries + 1):
+            try:
+                return await self.race(system_query, user_query, max_output_tokens, tokens)
+            except Exception as e:
+                if not is_quota_error(e):
+                    raise
+                error = e
+        raise QuotaExceeded(f"Rate limit reached: {str(error)}", retry_after=retry_after_hint(error)) from error
+
+    async def race(self, system_query, user_query, max_output_tokens, tokens):
+        candidates = self.ranked(tokens)
+        running = {}
+        error = None
+
+        async def launch():
+            backend = candidates.pop(0)
+            # Backends that are out of quota sort last, so this only waits when all of them are
+            await self.throttle(backend, tokens)
+            running[self.submit(backend, system_query, user_query, max_output_tokens, tokens)] = backend
+
+        await launch()
+        try:
+            while running:
+                delay = None
+                # Hedging to a backend without quota left would only make it wait for its turn
+                if self.hedge and candidates and len(running) == 1 and candidates[0].limiter.delay(tokens) == 0:
+                    delay = self.hedge_delay(next(iter(running.values())))
+                done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logging.info(f"Hedging slow call to {next(iter(running.values())).name} with {candidates[0].name}")
+                    metrics.inc('opk_hedged_calls_total', backend=candidates[0].name)
+                    await launch()
+                    continue
+                for future in done:
+                    backend = running.pop(future)
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+                    if is_quota_error(error):
+                        self.quota_error(backend, error)
+                    else:
+                        logging.warning(f"Backend {backend.name} failed: {str(error)}")
+                if not running and candidates:
+                    await launch()
+            raise error
+        finally:
+            # The worker threads cannot be interrupted, their answers are just dropped
+            for future in running:
+                future.cancel()
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+# Lower runs first: someone is waiting on a keystroke for a quick suggestion, nobody for a prefetch
+PRIORITY_CLASSES = ('quick', 'generate', 'batch', 'prefetch')
+ROUTE_PRIORITIES = {
+    '/quick_suggest': 'quick',
+    '/generate': 'generate',
+    '/generate_stream': 'generate',
+    '/batch': 'batch',
+    '/prefetch': 'prefetch'
+}
+
+# Set per request by the limit_concurrency middleware, and to 'prefetch' in prefetch tasks
+request_priority = contextvars.ContextVar('request_priority', default='generate')
+
+class Ticket:
+    """A place in the upstream queue; one per single-flight call, so joiners can promote it."""
+
+    def __init__(self, priority_class):
+        self.priority_class = priority_class
+        self.running_class = None
+        self.enqueued = 0.0
+        self.granted = None
+
+    def rank(self, now, aging):
+        # Every `aging` seconds of waiting moves a ticket up one class, so nothing starves
+        return PRIORITY_CLASSES.index(self.priority_class) - (now - self.enqueued) / aging
+
+class PriorityScheduler:
+    """Admission queue for model calls with per-class concurrency limits.
+
+    Quick calls only count against their own limit. The other classes also
+    share `total` slots, so batch and prefetch work can never occupy the
+    capacity quick suggestions need.
+    """
+
+    def __init__(self, limits, total, aging=5.0):
+        self.limits = limits
+        self.total = total
+        self.aging = aging
+        self.running = dict.fromkeys(PRIORITY_CLASSES, 0)
+        self.waiting = []
+
+    def _can_run(self, priority_class):
+        if self.running[priority_class] >= self.limits[priority_class]:
+            return False
+        if priority_class == 'quick':
+            return True
+        return sum(self.running.values()) - self.running['quick'] < self.total
+
+    def _start(self, ticket):
+        ticket.running_class = ticket.priority_class
+        self.running[ticket.running_class] += 1
+        metrics.observe('opk_queue_wait_seconds', time.monotonic() - ticket.enqueued, priority=ticket.running_class)
+        ticket.granted.set_result(None)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.waiting:
+            eligible = [ticket for ticket in self.waiting if self._can_run(ticket.priority_class)]
+            if not eligible:
+                return
+            best = min(eligible, key=lambda ticket: ticket.rank(now, self.aging))
+            self.waiting.remove(best)
+            self._start(best)
+
+    async def acquire(self, ticket):
+        ticket.enqueued = time.monotonic()
+        ticket.granted = asyncio.get_running_loop().create_future()
+        self.waiting.append(ticket)
+        self._dispatch()
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+            elif ticket.running_class is not None:
+                self.release(ticket)
+            raise
+
+    def release(self, ticket):
+        self.running[ticket.running_class] -= 1
+        ticket.running_class = None
+        self._dispatch()
+
+    def promote(self, ticket, priority_class):
+        if PRIORITY_CLASSES.index(priority_class) < PRIORITY_CLASSES.index(ticket.priority_class):
+            ticket.priority_class = priority_class
+            self._dispatch()
+
+    def depth(self, priority_class):
+        return sum(1 for ticket in self.waiting if ticket.priority_class == priority_class)
+
+# The ticket of the single-flight call being made, shared by everyone waiting on it
+flight_ticket = contextvars.ContextVar('flight_ticket', default=None)
+
+def current_priority():
+    # A single-flight call runs at the priority of its most urgent waiter
+    ticket = flight_ticket.get()
+    return ticket.priority_class if ticket is not None else request_priority.get()
+
+def model_executor():
+    # Quick calls get threads of their own, so they never queue behind calls that hold no
+    # scheduler slot any more: hedges that lost and calls abandoned at request_timeout
+    return quick_executor if current_priority() == 'quick' else executor
+
+class upstream_slot:
+    """async with upstream_slot(timeout): hold a scheduler slot for one model call."""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        self.ticket = flight_ticket.get()
+        if self.ticket is None or self.ticket.granted is not None:
+            # Only the first call of a flight can be promoted by joiners
+            self.ticket = Ticket(request_priority.get())
+        if scheduler is not None:
+            await asyncio.wait_for(scheduler.acquire(self.ticket), timeout=self.timeout)
+
+    async def __aexit__(self, *exc_info):
+        if scheduler is not None and self.ticket.running_class is not None:
+            scheduler.release(self.ticket)
+
+def init_scheduler():
+    global scheduler
+    defaults = {'quick': 8, 'generate': 4, 'batch': 2, 'prefetch': 1}
+    scheduler = PriorityScheduler(
+        limits={name: config.getint('scheduler', name, fallback=default) for name, default in defaults.items()},
+        total=config.getint('optionk', 'max_concurrent_requests', fallback=8),
+        aging=config.getfloat('scheduler', 'aging', fallback=5.0)
+    )
+
+FAKE_RESPONSE = """0. ls -la - List all files in the current directory with details
+1. du -sh * - Show the size of each item in the current directory
+2. df -h - Show free disk space on all mounted filesystems
+3. find . -type f -size +100M - Find files larger than 100MB
+4. ps aux --sort=-%mem - List processes sorted by memory use
+"""
+
+class FakeUsage:
+    def __init__(self, prompt, output):
+        # Roughly four characters per token, close enough for load tests
+        self.prompt_token_count = len(prompt) // 4
+        self.candidates_token_count = len(output) // 4
+
+class FakeResponse:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+class FakeModel:
+    """Offline stand-in for a Gemini model, for benchmarks and load tests.
+
+    Answers after latency seconds (plus up to jitter more), streams
+    response one line per chunk_delay seconds, and fails a failure_rate
+    fraction of calls.
+    """
+
+    def __init__(self, latency=0.2, jitter=0.0, chunk_delay=0.02, failure_rate=0.0, response=FAKE_RESPONSE,
+                 system_instruction=None):
+        self.system_instruction = system_instruction or ""
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.failure_rate = failure_rate
+        self.response = response
+
+    def generate_content(self, contents, generation_config=None, safety_settings=None, stream=False):
+        prompt = self.system_instruction + (contents[0] if isinstance(contents, list) else contents)
+        if stream:
+            return self._stream(prompt)
+        self._wait()
+        # A non-streaming call is a quick suggestion, which is a single command
+        command = self.response.splitlines()[0].split('. ', 1)[-1].split(' - ')[0]
+        return FakeResponse(f"`{command}`", FakeUsage(prompt, command))
+
+    def _wait(self):
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Fake backend failure")
+
+    def _stream(self, prompt):
+        self._wait()
+        lines = self.response.splitlines(keepends=True)
+        for i, line in enumerate(lines):
+            if i:
+                time.sleep(self.chunk_delay)
+            # Like the real SDK, the last chunk carries the usage totals for the whole stream
+            yield FakeResponse(line, FakeUsage(prompt, self.response) if i == len(lines) - 1 else None)
+
+def configured_models(section):
+    return [name.strip() for name in config.get(section, 'model').split(',') if name.strip()]
+
+def rate_limiter(section, quota_share=1.0):
+    # Quotas are per model, so every model of a section gets its own buckets.
+    # Worker processes each get an equal share of it.
+    return RateLimiter(
+        requests_per_minute=config.getfloat(section, 'requests_per_minute', fallback=0) * quota_share,
+        tokens_per_minute=config.getfloat(section, 'tokens_per_minute', fallback=0) * quota_share,
+        burst=config.getfloat('backends', 'burst', fallback=5),
+        backoff_base=config.getfloat('backends', 'backoff_base', fallback=1),
+        backoff_max=config.getfloat('backends', 'backoff_max', fallback=30)
+    )
+
+def init_backends(quota_share=1.0):
+    """Build the backend pool, importing only the SDKs of enabled providers."""
+    global backend_pool
+    backends = []
+    use_system_instruction = config.getboolean('prompts', 'system_instruction', fallback=True)
+
+    if config.getboolean('fake', 'enabled', fallback=False):
+        def make_fake_model(system_instruction):
+            return FakeModel(
+                latency=config.getfloat('fake', 'latency', fallback=0.2),
+                jitter=config.getfloat('fake', 'jitter', fallback=0.0),
+                chunk_delay=config.getfloat('fake', 'chunk_delay', fallback=0.02),
+                failure_rate=config.getfloat('fake', 'failure_rate', fallback=0.0),
+                system_instruction=system_instruction
+            )
+        for name in configured_models('fake') if config.has_option('fake', 'model') else ['fake']:
+            backends.append(Backend(f"fake/{name}", make_fake_model, dict, None, system_instruction=use_system_instruction,
+                                    limiter=rate_limiter('fake', quota_share)))
+        logging.info("Initialized fake model")
+
+    if config.getboolean('vertexai', 'enabled', fallback=False):
+        import vertexai
+        from vertexai.generative_models import GenerativeModel, GenerationConfig, HarmCategory, HarmBlockThreshold
+
+        vertexai.init(project=config.get('vertexai', 'project'), location=config.get('vertexai', 'location'))
+        safety_settings = {
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH
+        }
+        for name in configured_models('vertexai'):
+            backends.append(Backend(
+                f"vertexai/{name}",
+                lambda system_instruction, name=name: GenerativeModel(name, system_instruction=system_instruction),
+                GenerationConfig, safety_settings, wrap_contents=True, system_instruction=use_system_instruction,
+                limiter=rate_limiter('vertexai', quota_share)
+            ))
+        logging.info("Initialized Vertex AI model")
+
+    if config.getboolean('google_ai_studio', 'enabled', fallback=False):
+        import google.generativeai as genai
+        from google.generativeai.types import HarmCategory, HarmBlockThreshold
+
+        genai.configure(api_key=config.get('google_ai_studio', 'api_key'))
+        safety_settings = {
+            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE
+        }
+        for name in configured_models('google_ai_studio'):
+            backends.append(Backend(
+                f"google_ai_studio/{name}",
+                lambda system_instruction, name=name: genai.GenerativeModel(name, system_instruction=system_instruction),
+                genai.GenerationConfig, safety_settings, system_instruction=use_system_instruction,
+                limiter=rate_limiter('google_ai_studio', quota_share)
+            ))
+        logging.info("Initialized Google AI Studio model")
+
+    if not backends:
+        raise ValueError("No AI service is enabled in the configuration")
 
+    backend_pool = BackendPool(
+        backends,
+        hedge=config.getboolean('backends', 'hedge', fallback=True),
+        hedge_quantile=config.getfloat('backends', 'hedge_quantile', fallback=0.9),
+        hedge_min_delay=config.getfloat('backends', 'hedge_min_delay', fallback=0.2),
+        hedge_max_delay=config.getfloat('backends', 'hedge_max_delay', fallback=2.0),
+        retries=config.getint('backends', 'retries', fallback=2),
+        shed=[name.strip() for name in config.get('backends', 'shed', fallback='batch, prefetch').split(',') if name.strip()]
+    )
+
+async def check_health():
+    """Make one tiny model call and record whether the backend answered."""
+    try:
+        await call_model(None, "Reply with OK.", max_output_tokens=5)
+        health.update(status='ok', error=None, checked=time.time())
+        logging.info("API test successful")
+    except Exception as e:
+        health.update(status='error', error=str(e), checked=time.time())
+        logging.error(f"API test failed: {str(e)}")
+
+async def start_background_health_check(app):
+    # Runs once the listener is up instead of delaying it by a full model round-trip
+    if config.getboolean('optionk', 'startup_check', fallback=True):
+        app['health_check'] = asyncio.ensure_future(check_health())
+    else:
+        health['status'] = 'unchecked'
+
+async def handle_health(request):
+    if request.query.get('check'):
+        await check_health()
+    backends = backend_pool.stats() if backend_pool is not None else []
+    return web.json_response(dict(health, backends=backends, pid=os.getpid()))
+
+async def call_model(system_query, user_query, max_output_tokens):
+    timeout = config.getfloat('optionk', 'request_timeout', fallback=30)
+
+    async def call():
+        async with upstream_slot():
+            with stage('upstream'):
+                return await backend_pool.call(system_query, user_query, max_output_tokens)
+
+    # The worker threads cannot be interrupted, but the request stops waiting for them.
+    # The timeout includes the time spent queued in the scheduler.
+    return await asyncio.wait_for(call(), timeout=timeout)
+
+async def stream_model(system_query, user_query, max_output_tokens):
+    """Yield response text chunks as soon as the worker thread receives them.
+
+    Until the first chunk arrives a stream is hedged like a plain call, and a
+    backend that fails before its first chunk is replaced by the next one.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + config.getfloat('optionk', 'request_timeout', fallback=30)
+    async with upstream_slot(timeout=config.getfloat('optionk', 'request_timeout', fallback=30)):
+        async for chunk in stream_backends(system_query, user_query, max_output_tokens, deadline):
+            yield chunk
+
+async def stream_backends(system_query, user_query, max_output_tokens, deadline):
+    loop = asyncio.get_running_loop()
+    tokens = estimate_tokens(system_query, user_query, max_output_tokens)
+    backend_pool.admit(tokens)
+    candidates = backend_pool.ranked(tokens)
+    retries = backend_pool.retries
+    # Every stream puts its chunks here tagged with its stop event, the first to send one wins
+    events = asyncio.Queue()
+    starting = {}  # Stop event -> (backend, start time) of streams yet to send a chunk
+    winner = None  # (stop event, backend, start time) of the stream being read
+
+    def produce(backend, stop):
+        try:
+            chunk = None
+            for chunk in backend.generate(system_query, user_query, max_output_tokens, stream=True):
+                if stop.is_set():
+                    break
+                if chunk.text:
+                    loop.call_soon_threadsafe(events.put_nowait, (stop, chunk.text))
+            # The last chunk carries the usage totals for the whole stream
+            if chunk is not None:
+                backend.limiter.settle(tokens, backend.count_tokens(chunk))
+        except Exception as e:
+            loop.call_soon_threadsafe(events.put_nowait, (stop, e))
+        finally:
+            loop.call_soon_threadsafe(events.put_nowait, (stop, None))
+
+    async def launch():
+        backend = candidates.pop(0)
+        await backend_pool.throttle(backend, tokens)
+        stop = threading.Event()
+        starting[stop] = (backend, loop.time())
+        loop.run_in_executor(model_executor(), produce, backend, stop)
+
+    await launch()
+    try:
+        while True:
+            timeout = max(deadline - loop.time(), 0)
+            hedge = None
+            # Like a plain call, a stream slow to start is hedged with the next backend that has quota left
+            if (winner is None and backend_pool.hedge and len(starting) == 1 and candidates
+                    and candidates[0].limiter.delay(tokens) == 0):
+                hedge, started = next(iter(starting.values()))
+                timeout = min(timeout, max(started + backend_pool.hedge_delay(hedge) - loop.time(), 0))
+            try:
+                stop, item = await asyncio.wait_for(events.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                if hedge is None or loop.time() >= deadline:
+                    raise
+                logging.info(f"Hedging slow stream from {hedge.name} with {candidates[0].name}")
+                metrics.inc('opk_hedged_calls_total', backend=candidates[0].name)
+                await launch()
+                continue
+
+            if winner is not None and stop is winner[0]:
+                _, backend, started = winner
+                if item is None:
+                    metrics.observe('opk_upstream_seconds', loop.time() - started, backend=backend.name)
+                    record_stage('upstream', loop.time() - started)
+                    return
+                if isinstance(item, Exception):
+                    backend.record(None, False)
+                    raise item
+                yield item
+                continue
+            if stop not in starting:
+                continue  # The rest of a stream that failed or lost the race
+
+            backend, started = starting.pop(stop)
+            if isinstance(item, Exception):
+                backend.record(None, False)
+                if is_quota_error(item):
+                    backend_pool.quota_error(backend, item)
+                    if not starting and not candidates and retries:
+                        # Every backend is out of quota, wait out the shortest backoff
+                        retries -= 1
+                        candidates = backend_pool.ranked(tokens)
+                    if not starting and not candidates:
+                        raise QuotaExceeded(f"Rate limit reached: {str(item)}", retry_after=retry_after_hint(item)) from item
+                elif not starting and not candidates:
+                    raise item
+                else:
+                    logging.warning(f"Backend {backend.name} failed before streaming: {str(item)}")
+                if not starting:
+                    await launch()
+                continue
+
+            # The first chunk decides the race, the other streams are dropped
+            winner = (stop, backend, started)
+            for other in starting:
+                other.set()
+            starting.clear()
+            # Time to first chunk is what a streaming caller waits on
+            backend.record(loop.time() - started, True)
+            if item is None:
+                metrics.observe('opk_upstream_seconds', loop.time() - started, backend=backend.name)
+                record_stage('upstream', loop.time() - started)
+                return
+            backend.limiter.succeeded()
+            metrics.observe('opk_upstream_first_chunk_seconds', loop.time() - started, backend=backend.name)
+            record_stage('upstream_first_chunk', loop.time() - started)
+            yield item
+    finally:
+        # Lets the workers drop the rest of the upstream streams if the client went away
+        for stop in starting:
+            stop.set()
+        if winner is not None:
+            winner[0].set()
+
+async def single_flight(key, fetch):
+    """Share one upstream call between all concurrent requests for the same key."""
+    flight = inflight_requests.get(key)
+    if flight is None:
+        ticket = Ticket(request_priority.get())
+
+        async def run():
+            flight_ticket.set(ticket)
+            return await fetch()
+
+        flight = {'task': asyncio.ensure_future(run()), 'waiters': 0, 'ticket': ticket}
+        inflight_requests[key] = flight
+        flight['task'].add_done_callback(lambda _: inflight_requests.pop(key, None))
+    elif scheduler is not None:
+        # A quick request joining a queued prefetch of the same query must not wait at prefetch priority
+        scheduler.promote(flight['ticket'], request_priority.get())
+
+    flight['waiters'] += 1
+    try:
+        # shield() keeps one disconnecting client from cancelling the call for everyone else
+        return await asyncio.shield(flight['task'])
+    except asyncio.CancelledError:
+        if flight['waiters'] == 1 and not flight['task'].done():
+            flight['task'].cancel()
+        raise
+    finally:
+        flight['waiters'] -= 1
+
+async def iter_cached(text):
+    yield text
+
+SUGGESTION_PATTERN = re.compile(r"^\s*[*_]*(\d+)[.)][*_]*\s+(.*\S)\s*$")
+# A code span is the command only when it starts the item, later ones are part of the explanation
+CODE_SPAN_PATTERN = re.compile(r"[*_]*`+([^`]+)`+")
+
+def parse_suggestion(line):
+    """Parse a '<n>. <command> - <explanation>' line into a record, or None."""
+    match = SUGGESTION_PATTERN.match(line)
+    if match is None:
+        return None
+    rest = match.group(2)
+    code = CODE_SPAN_PATTERN.match(rest)
+    if code is not None:
+        command = code.group(1).strip()
+        explanation = rest[code.end():].lstrip(' *_:-\u2013\u2014')
     else:
-        system_query = f"""Machine-readable output.
+        command, _, explanation = rest.partition(' - ')
+        command = command.strip()
+        # Only strip paired bold markers, a trailing * may be a shell glob
+        if len(command) > 4 and command.startswith('**') and command.endswith('**'):
+            command = command[2:-2].strip()
+    if not command:
+        return None
+    return {'index': int(match.group(1)), 'command': command, 'explanation': explanation.strip()}
+
+class SuggestionParser:
+    """Turn streamed model output into suggestion records as each line completes."""
+
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, chunk):
+        self.pending += chunk
+        *lines, self.pending = self.pending.split("\n")
+        return [suggestion for suggestion in map(parse_suggestion, lines) if suggestion is not None]
+
+    def close(self):
+        line, self.pending = self.pending, ""
+        suggestion = parse_suggestion(line)
+        return [suggestion] if suggestion is not None else []
+
+def parse_suggestions(text):
+    parser = SuggestionParser()
+    return parser.feed(text) + parser.close()
+
+def compact_prompt(text):
+    """Drop the source indentation and blank lines, which would otherwise be sent (and billed) upstream."""
+    return "\n".join(line.strip() for line in text.strip().splitlines() if line.strip())
+
+PROMPT_TEMPLATES = {name: compact_prompt(template) for name, template in {
+    'generate': """
+        Machine-readable output. You are a {expert} expert providing {command_type} commands that match the query.
+        The user's system is: {system_info}
+        Provide commands specific to this system.
+        Rank suggestions by relevance.
+        Explain what each command does and how it works.
+        Output as a numbered list (starts with 0) in the format: <command> - <explanation>.
+    """,
+    'generate_git': """
+        Machine-readable output. You are a Git expert providing git commands that match the query.
+        Provide git commands specific to this system.
+        Rank suggestions by relevance.
+        Explain what each git command does and how it works.
+        Output as a numbered list (starts with 0) in the format: <git command> - <explanation>.
+    """,
+    'quick': """
+        Machine-readable output.
         Output with JUST the command to run directly in the command line.
-        You are a CLI expert providing the single best {command_type} command that matches the query.
+        You are a {expert} expert providing the single best {command_type} command that matches the query.
         The user's system is: {system_info}
         Provide a command specific to this system.
-        """
-    
-    full_query = f"{system_query}\n\nquery: {query}\n\n"
-    
-    if config.getboolean('vertexai', 'enabled', fallback=False):
-        response = model.generate_content(
-            [full_query],
-            generation_config=GenerationConfig(
-                max_output_tokens=500,
-                temperature=0,
-                top_p=1,
-                top_k=1
-            ),
-            safety_settings=vertex_safetysettings,
-            stream=False,
-        )
-        return response.text.strip('` \t\n\r')
-    else:  # Google AI Studio
-        response = model.generate_content(
-            full_query,
-            generation_config=genai.GenerationConfig(
-                max_output_tokens=100,
-                temperature=0,
-                top_p=1,
-                top_k=1
-            ),
-            safety_settings=googleai_safetysettings,
-        )
-        return response.text.strip('` \t\n\r')
+    """,
+    'quick_git': """
+        Machine-readable output.
+        Output with JUST the command to run directly in the command line.
+        You are a Git expert providing the single best git command that matches the query.
+    """,
+    'quick_git_commit': """
+        Machine-readable output.
+        Output with JUST the command to run directly in the command line.
+        You are a Git expert providing the single best git command that matches the query.
+        For commit messages:
+        1. Rewrite the commit message to meet Conventional Commits Specification.
+        2. Use the block-style commit message format with a single pair of quotes.
+        3. Separate the title from the body with a blank line.
+        4. Wrap the body text at approximately 72 characters.
+        5. Output just the git commit command.
+    """,
+    'batch': """
+        Machine-readable output.
+        You are a {expert} expert providing the single best {command_type} command for each numbered query.
+        The user's system is: {system_info}
+        Answer every query on its own line in the format: <number>. <command>
+        Output JUST the commands, without explanations.
+    """,
+}.items()}
 
-async def handle_generate(request):
+@lru_cache(maxsize=512)
+def system_prompt(kind, family, command_type, system_info, commit_message=False):
+    """The system prompt for a kind of request, built once per query family and system."""
+    if family == 'git' and kind == 'quick' and commit_message:
+        return PROMPT_TEMPLATES['quick_git_commit']
+    if family == 'git' and kind != 'batch':
+        return PROMPT_TEMPLATES[f"{kind}_git"]
+    expert, command_type = family_prompt_terms(family, command_type)
+    return PROMPT_TEMPLATES[kind].format(expert=expert, command_type=command_type, system_info=system_info)
+
+# Output token limits, the same for every backend
+TOKEN_BUDGETS = {'quick': 256, 'generate': 1024, 'batch_per_query': 100, 'batch': 2048}
+
+def token_budget(kind):
+    return config.getint('tokens', kind, fallback=TOKEN_BUDGETS[kind])
+
+def family_prompt_terms(family, command_type):
+    if family is None:
+        return "CLI", command_type
+    return QUERY_FAMILIES[family]['expert'], QUERY_FAMILIES[family]['command']
+
+def build_generate_query(query, command_type, system_info):
+    start = time.perf_counter()
+    with stage('classify'):
+        family = classify_query(query)
+    system_query = system_prompt('generate', family, command_type, system_info)
+    record_stage('prompt', time.perf_counter() - start)
+    return system_query, f"query: {query}\n\nProvide up to 9 commands."
+
+def cached_generate_result(query, namespace, use_cache=True):
+    with stage('cache'):
+        cached = cache_get(namespace, query, use_cache)
+    if cached is not None:
+        metrics.inc('opk_answers_total', kind='generate', source='cache')
+        return cached
+    with stage('local_index'):
+        cached = local_generate_answer(query)
+    if cached is not None:
+        metrics.inc('opk_answers_total', kind='generate', source='local')
+    return cached
+
+async def generate_response_stream(query, command_type, system_info, use_cache=True):
+    system_query, user_query = build_generate_query(query, command_type, system_info)
+    namespace = cache_namespace('generate', system_query, system_info)
+    cached = cached_generate_result(query, namespace, use_cache)
+    if cached is not None:
+        return cached
+
+    async def fetch():
+        parser = SuggestionParser()
+        received = []
+        with publish_first_suggestion(cache_key(namespace, query)) as first:
+            async for chunk in stream_model(system_query, user_query, token_budget('generate')):
+                received.append(chunk)
+                if not first.done():
+                    for suggestion in parser.feed(chunk)[:1]:
+                        first.set_result(suggestion['command'])
+        response = "".join(received)
+        metrics.inc('opk_answers_total', kind='generate', source='model')
+        cache_put(namespace, query, response)
+        return response
+
+    return await single_flight(cache_key(namespace, query), fetch)
+
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+')
+WORD_PATTERN = re.compile(r"[a-z0-9][a-z0-9_-]*")
+DOWNLOAD_COMMANDS = ("curl", "wget")
+
+QUERY_FAMILIES = {}
+family_terms = {}
+family_typos = {}
+TOOL_WEIGHT, TERM_WEIGHT = 2, 1
+
+def register_query_family(name, terms, expert, command=None, tools=()):
+    """Route queries mentioning any of terms to a prompt for that tool.
+
+    Naming a tool (the family name or one of tools) outranks the shared verbs in
+    terms, so "docker commit" goes to docker rather than git. Between hits of the
+    same kind the family registered first wins. Inflected forms ("commits",
+    "merged") match exactly; terms of 7 or more letters also match with a single typo.
+    """
+    QUERY_FAMILIES[name] = {'expert': expert, 'command': command or name, 'priority': len(QUERY_FAMILIES)}
+    tools = {name, *tools}
+    for term in [*tools, *terms]:
+        weight = TOOL_WEIGHT if term in tools else TERM_WEIGHT
+        forms = [term, term + "s", term + "es", term + "ed", term + "d", term + "ing"]
+        if term.endswith("e"):
+            forms.append(term[:-1] + "ing")
+        for form in forms:
+            add_family_term(family_terms, form, name, weight)
+            if len(form) >= 7:
+                # Symmetric-delete index: two words within one edit share a single-deletion variant
+                add_family_term(family_typos, form, name, weight)
+                for i in range(len(form)):
+                    add_family_term(family_typos, form[:i] + form[i + 1:], name, weight)
+    classify_query.cache_clear()
+
+def add_family_term(index, form, family, weight):
+    # A heavier hit replaces a lighter one, otherwise the family registered first keeps the term
+    current = index.get(form)
+    if current is None or weight > current[1]:
+        index[form] = (family, weight)
+
+def match_family_typo(word):
+    hit = family_typos.get(word)
+    if hit is not None:
+        return hit
+    for i in range(len(word)):
+        hit = family_typos.get(word[:i] + word[i + 1:])
+        if hit is not None:
+            return hit
+    return None
+
+def family_rank(hit):
+    family, weight = hit
+    return weight, -QUERY_FAMILIES[family]['priority']
+
+@lru_cache(maxsize=4096)
+def classify_query(query):
+    """Return the registered family a query belongs to, or None for a generic CLI query."""
+    query = query.lower()
+    urls = URL_PATTERN.findall(query)
+    words = WORD_PATTERN.findall(URL_PATTERN.sub(" ", query))
+
+    best = None
+    for word in words:
+        hit = family_terms.get(word)
+        if hit is None and len(word) >= 6:
+            hit = match_family_typo(word)
+        if hit is None:
+            continue
+        if best is None or family_rank(hit) > family_rank(best):
+            best = hit
+    best = best[0] if best is not None else None
+
+    if best == 'git':
+        # "download https://github.com/..." is about fetching a file, not about git
+        if any('git' in url for url in urls) or any(command in words for command in DOWNLOAD_COMMANDS):
+            return None
+    return best
+
+def is_git_related_query(query):
+    return classify_query(query) == 'git'
+
+register_query_family('git', ["commit", "branch", "merge", "pull", "push", "rebase", "stash", "checkout", "clone"], "Git")
+register_query_family('kubectl', ["pod"], "Kubernetes", tools=["kubernetes", "k8s", "kubeconfig"])
+register_query_family('docker', [], "Docker", tools=["dockerfile", "docker-compose"])
+register_query_family('systemctl', [], "systemd", tools=["systemd", "journalctl"])
+
+def is_commit_message_query(query):
+    return "commit" in query and "message" in query
+
+def build_quick_query(query, command_type, system_info):
+    start = time.perf_counter()
+    with stage('classify'):
+        family = classify_query(query)
+    system_query = system_prompt('quick', family, command_type, system_info, is_commit_message_query(query))
+    record_stage('prompt', time.perf_counter() - start)
+    return system_query, f"query: {query}"
+
+def cached_quick_result(query, command_type, system_info, use_cache=True):
+    # The command the user picked for this exact query before beats any generated answer
+    if use_cache:
+        with stage('history'):
+            picked = history_quick_answer(query)
+        if picked is not None:
+            metrics.inc('opk_answers_total', kind='quick', source='history')
+            return picked
+
+    system_query, _ = build_quick_query(query, command_type, system_info)
+    namespace = cache_namespace('quick', system_query, system_info)
+    with stage('cache'):
+        # A similar commit message query still needs its own message, so only exact hits apply
+        cached = cache_get(namespace, query, use_cache, fuzzy=not is_commit_message_query(query))
+    if cached is not None:
+        metrics.inc('opk_answers_total', kind='quick', source='cache')
+        return cached
+    with stage('local_index'):
+        cached = local_quick_answer(query)
+    if cached is not None:
+        metrics.inc('opk_answers_total', kind='quick', source='local')
+    return cached
+
+@contextmanager
+def publish_first_suggestion(key):
+    """Let quick requests for the same query use item 0 of a /generate answer still streaming in.
+
+    The call's scheduler ticket is published with it, so quick requests can
+    tell a call that is already answering from one still queued for a slot.
+    """
+    future = asyncio.get_running_loop().create_future()
+    ticket, token = flight_ticket.get(), None
+    if ticket is None or ticket.granted is not None:
+        ticket = Ticket(request_priority.get())
+        token = flight_ticket.set(ticket)
+    published = generate_first_suggestions.setdefault(key, (future, ticket))[0] is future
+    try:
+        yield future
+    finally:
+        if token is not None:
+            flight_ticket.reset(token)
+        if published:
+            del generate_first_suggestions[key]
+        if not future.done():
+            future.cancel()
+
+async def generate_quick_answer(query, command_type, system_info):
+    """Item 0 of a cached or in-flight /generate answer to the same query, or None."""
+    # /generate isn't asked to write commit messages, its first item would lack one
+    if is_commit_message_query(query):
+        return None
+    system_query, _ = build_generate_query(query, command_type, system_info)
+    namespace = cache_namespace('generate', system_query, system_info)
+    with stage('cache'):
+        # The quick lookup already counted this request as a hit or a miss
+        cached = cache_peek(namespace, query)
+    if cached is not None:
+        suggestions = parse_suggestions(cached)
+        return suggestions[0]['command'] if suggestions else None
+
+    published = generate_first_suggestions.get(cache_key(namespace, query))
+    if published is None:
+        return None
+    first, ticket = published
+    # Waiting on a call still queued for a slot would put this request behind the whole
+    # /generate queue, at /generate priority
+    if ticket.granted is None or not ticket.granted.done():
+        return None
+    # That call is already answering, so its first line usually arrives before a new call's
+    # would. It is given no longer than a quick call gets before it is hedged.
+    # asyncio.wait() neither raises nor cancels if it ends without a suggestion.
+    with stage('generate_wait'):
+        await asyncio.wait([first], timeout=config.getfloat('backends', 'hedge_max_delay', fallback=2.0))
+    if first.done() and not first.cancelled():
+        return first.result()
+    return None
+
+# A line like these still continues on the next one
+INCOMPLETE_COMMAND_PATTERN = re.compile(r"(\\|\||&&|[{(]|\b(do|then|else|in))\s*$")
+HEREDOC_PATTERN = re.compile(r"<<-?\s*['\"]?\w")
+COMPOUND_WORDS = {'do': 1, 'then': 1, 'case': 1, '{': 1, 'done': -1, 'fi': -1, 'esac': -1, '}': -1}
+# First words of a sentence introducing the command, none of them is a command itself
+PROSE_LEAD_INS = frozenset({
+    'a', 'an', 'the', 'this', 'that', 'these', 'here', 'here\'s', 'to', 'use', 'try', 'you', 'i',
+    'it', 'run', 'execute', 'sure', 'certainly', 'ok', 'okay', 'below', 'following', 'note', 'assuming'
+})
+
+def complete_command(lines):
+    """The command in `lines` if it is a complete, plausible command line, else None."""
+    if len(lines) == 1:
+        suggestion = parse_suggestion(lines[0])
+        if suggestion is not None:
+            return suggestion['command']
+    command = "\n".join(lines).strip().strip('`').strip()
+    if not command or INCOMPLETE_COMMAND_PATTERN.search(command) or HEREDOC_PATTERN.search(command):
+        return None
+    try:
+        # Fails on an unterminated quote, e.g. in the first line of a multi-line commit message
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    # An unclosed for/if/case/{ block continues on the next line
+    depth = sum(COMPOUND_WORDS.get(word, 0) for word in words)
+    return command if depth <= 0 else None
+
+def is_prose(line):
+    if SUGGESTION_PATTERN.match(line):
+        return False  # "0. ls -la - List files"
+    first_word = line.split(None, 1)[0]
+    return line.endswith(':') or first_word[-1] in ',.!?' or first_word.lower() in PROSE_LEAD_INS
+
+def first_command(text):
+    """The first complete command among the finished lines of `text`, or None."""
+    lines = []
+    fenced = False
+    for line in text.split("\n")[:-1]:
+        stripped = line.strip()
+        if stripped.startswith('```'):
+            fenced = not fenced
+            continue
+        # Blank lines and a "Here is the command" preamble are not part of it,
+        # though a preamble may quote the command: "Run `ls -la` to list them."
+        if not lines and not stripped:
+            continue
+        if not lines and not fenced and is_prose(stripped):
+            code = re.search(r"`([^`]+)`", stripped)
+            command = complete_command([code.group(1)]) if code is not None else None
+            if command is not None:
+                return command
+            continue
+        lines.append(line)
+        command = complete_command(lines)
+        if command is not None:
+            return command
+    return None
+
+async def stream_quick_command(system_query, user_query):
+    """Stream a quick suggestion and return as soon as its first complete command line arrives.
+
+    Closing the stream early tells the worker to drop the rest of the answer,
+    so the request waits for one line rather than the whole response.
+    """
+    chunks = stream_model(system_query, user_query, token_budget('quick'))
+    received = ""
+    try:
+        async for chunk in chunks:
+            received += chunk
+            if "\n" in chunk:
+                command = first_command(received)
+                if command is not None:
+                    metrics.inc('opk_quick_early_stops_total')
+                    return command
+    finally:
+        await chunks.aclose()
+    return first_command(received + "\n") or received.strip('` \t\n\r')
+
+async def get_single_best_result(query, command_type, system_info, use_cache=True):
+    cached = cached_quick_result(query, command_type, system_info, use_cache)
+    if cached is not None:
+        return cached
+
+    system_query, user_query = build_quick_query(query, command_type, system_info)
+    namespace = cache_namespace('quick', system_query, system_info)
+
+    async def fetch():
+        result = await generate_quick_answer(query, command_type, system_info) if use_cache else None
+        if result is not None:
+            metrics.inc('opk_answers_total', kind='quick', source='generate')
+        elif config.getboolean('backends', 'stream_quick', fallback=True):
+            result = await stream_quick_command(system_query, user_query)
+            metrics.inc('opk_answers_total', kind='quick', source='model')
+        else:
+            response = await call_model(system_query, user_query, token_budget('quick'))
+            metrics.inc('opk_answers_total', kind='quick', source='model')
+            result = response.strip('` \t\n\r')
+        cache_put(namespace, query, result)
+        if local_index is not None and not is_commit_message_query(query):
+            local_index.learn(query, result)
+        return result
+
+    return await single_flight(cache_key(namespace, query), fetch)
+
+BATCH_LINE_PATTERN = re.compile(r"^\s*(\d+)[.)]\s*(.+)$")
+
+def build_batch_prompt(command_type, system_info):
+    return system_prompt('batch', None, command_type, system_info)
+
+async def get_packed_results(queries, command_type, system_info, use_cache=True):
+    """Answer several quick queries with one model call.
+
+    Returns a dict of query to command. Queries the model skipped are left
+    out, so callers can fall back to get_single_best_result for them.
+    """
+    system_query = build_batch_prompt(command_type, system_info)
+    namespace = cache_namespace('batch', system_query, system_info)
+    results = {}
+    misses = []
+    for query in queries:
+        cached = cache_get(namespace, query, use_cache, fuzzy=False)
+        if cached is not None:
+            results[query] = cached
+        else:
+            misses.append(query)
+    if not misses:
+        return results
+
+    numbered = "\n".join(f"{i}. {query}" for i, query in enumerate(misses, 1))
+    response = await call_model(
+        system_query,
+        f"queries:\n{numbered}",
+        min(token_budget('batch_per_query') * len(misses), token_budget('batch'))
+    )
+    for line in response.splitlines():
+        match = BATCH_LINE_PATTERN.match(line)
+        if match is None:
+            continue
+        position = int(match.group(1)) - 1
+        if 0 <= position < len(misses) and misses[position] not in results:
+            command = match.group(2).strip('` \t\r')
+            results[misses[position]] = command
+            cache_put(namespace, misses[position], command)
+    return results
+
+async def handle_batch(request):
     data = await request.json()
-    query = data['query']
+    mode = data.get('mode', 'quick')
+    if mode not in ('quick', 'generate'):
+        return web.json_response({'error': f"Unknown mode: {mode}"}, status=400)
+    queries = [normalize_query(query) for query in data['queries']]
+    if len(queries) > config.getint('batch', 'max_queries', fallback=500):
+        return web.json_response({'error': 'Too many queries in one batch'}, status=400)
+
+    use_cache = not data.get('no_cache')
     system_info = get_system_info()
-    response = await generate_response_stream(query, "CLI", system_info)
-    return web.json_response({'response': response})
+    slots = asyncio.Semaphore(config.getint('batch', 'concurrency', fallback=4))
+    pack_size = int(data.get('pack', config.getint('batch', 'pack_size', fallback=0)))
+
+    # Duplicate queries are answered once and reported at every position they appeared
+    positions = {}
+    for i, query in enumerate(queries):
+        positions.setdefault(query, []).append(i)
+
+    async def answer(query):
+        try:
+            async with slots:
+                if mode == 'quick':
+                    return [(query, {'result': await get_single_best_result(query, "CLI", system_info, use_cache)})]
+                generated = await generate_response_stream(query, "CLI", system_info, use_cache)
+                return [(query, {'response': generated, 'suggestions': parse_suggestions(generated)})]
+        except Exception as e:
+            return [(query, {'error': str(e) or type(e).__name__})]
+
+    async def answer_pack(group):
+        try:
+            async with slots:
+                results = await get_packed_results(group, "CLI", system_info, use_cache)
+        except Exception as e:
+            logging.warning(f"Packed batch call failed: {str(e)}")
+            results = {}
+        answered = [(query, {'result': result}) for query, result in results.items()]
+        for fallback in await asyncio.gather(*(answer(query) for query in group if query not in results)):
+            answered.extend(fallback)
+        return answered
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    async def write_answers(answers):
+        for query, payload in answers:
+            for i in positions[query]:
+                line = {'index': i, 'query': query, **payload}
+                await response.write(json.dumps(line).encode() + b"\n")
+
+    ready = []
+    jobs = []
+    if mode == 'quick' and pack_size > 1:
+        packable = []
+        for query in positions:
+            cached = cached_quick_result(query, "CLI", system_info, use_cache)
+            if cached is not None:
+                ready.append((query, {'result': cached}))
+            elif is_commit_message_query(query):
+                jobs.append(asyncio.ensure_future(answer(query)))
+            else:
+                packable.append(query)
+        for start in range(0, len(packable), pack_size):
+            jobs.append(asyncio.ensure_future(answer_pack(packable[start:start + pack_size])))
+    else:
+        jobs = [asyncio.ensure_future(answer(query)) for query in positions]
+
+    try:
+        await write_answers(ready)
+        # Stream each answer as soon as it is ready rather than in request order
+        for job in asyncio.as_completed(jobs):
+            await write_answers(await job)
+    finally:
+        for job in jobs:
+            job.cancel()
+    await response.write_eof()
+    return response
+
+async def read_query(request):
+    with stage('parse_request'):
+        data = await request.json()
+        return data, normalize_query(data['query'])
+
+trace_ids = iter(range(1, 1 << 62))
+
+@web.middleware
+async def instrument(request, handler):
+    if request.path == '/metrics':
+        return await handler(request)
+    # Label by route, not raw path, so unknown URLs can't create unbounded series
+    resource = request.match_info.route.resource
+    endpoint = resource.canonical if resource is not None else 'unmatched'
+    trace = {'endpoint': endpoint, 'stages': {}}
+    token = request_trace.set(trace)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        request_trace.reset(token)
+        metrics.inc('opk_requests_total', endpoint=endpoint, status=status)
+        metrics.observe('opk_request_seconds', elapsed, endpoint=endpoint)
+        if config.getboolean('metrics', 'trace', fallback=False):
+            logging.info("trace " + json.dumps({
+                'id': next(trace_ids),
+                'endpoint': endpoint,
+                'status': status,
+                'ms': round(elapsed * 1000, 2),
+                'stages': {name: round(seconds * 1000, 2) for name, seconds in trace['stages'].items()}
+            }))
+
+async def handle_metrics(request):
+    metrics.set('opk_pending_requests', pending_requests)
+    metrics.set('opk_inflight_upstream', len(inflight_requests))
+    metrics.set('opk_prefetch_tasks', len(prefetch_tasks))
+    if scheduler is not None:
+        for priority_class in PRIORITY_CLASSES:
+            metrics.set('opk_queue_depth', scheduler.depth(priority_class), priority=priority_class)
+            metrics.set('opk_upstream_running', scheduler.running[priority_class], priority=priority_class)
+    return web.Response(text=metrics.render(), content_type='text/plain', headers={'X-Content-Type-Options': 'nosniff'})
+
+pending_by_priority = dict.fromkeys(PRIORITY_CLASSES, 0)
+
+@web.middleware
+async def limit_concurrency(request, handler):
+    global pending_requests
+    # Monitoring must keep answering when the server is saturated
+    if request.path in ('/metrics', '/health'):
+        return await handler(request)
+    priority_class = ROUTE_PRIORITIES.get(request.path, 'generate')
+    # Shed load early instead of letting an unbounded queue build up behind the model.
+    # Counted per class, so a pile of /generate requests never turns quick suggestions away.
+    if pending_by_priority[priority_class] >= config.getint('optionk', 'max_pending_requests', fallback=32):
+        return web.json_response({'error': 'Server busy, try again'}, status=503, headers={'Retry-After': '1'})
+
+    request_priority.set(priority_class)
+    pending_requests += 1
+    pending_by_priority[priority_class] += 1
+    try:
+        # Model calls queue in the scheduler by priority; cache hits never wait at all
+        return await handler(request)
+    except asyncio.TimeoutError:
+        logging.warning(f"Model request timed out: {request.path}")
+        return web.json_response({'error': 'Model request timed out'}, status=504)
+    except QuotaExceeded as e:
+        retry_after = math.ceil(e.retry_after) if e.retry_after else 1
+        return web.json_response({'error': str(e)}, status=429, headers={'Retry-After': str(retry_after)})
+    finally:
+        pending_requests -= 1
+        pending_by_priority[priority_class] -= 1
+
+async def handle_generate(request):
+    data, query = await read_query(request)
+    system_info = get_system_info()
+    response = await generate_response_stream(query, "CLI", system_info, use_cache=not data.get('no_cache'))
+    with stage('parse_output'):
+        suggestions = parse_suggestions(response)
+    return web.json_response({'response': response, 'suggestions': suggestions})
+
+async def handle_generate_stream(request):
+    data, query = await read_query(request)
+    system_info = get_system_info()
+    system_query, user_query = build_generate_query(query, "CLI", system_info)
+    namespace = cache_namespace('generate', system_query, system_info)
+    cached = cached_generate_result(query, namespace, use_cache=not data.get('no_cache'))
+
+    # One suggestion record per line, flushed as soon as its line of model output is complete
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    try:
+        if cached is not None:
+            chunks = iter_cached(cached)
+        else:
+            chunks = stream_model(system_query, user_query, token_budget('generate'))
+        parser = SuggestionParser()
+        received = []
+        with publish_first_suggestion(cache_key(namespace, query)) as first:
+            async for chunk in chunks:
+                received.append(chunk)
+                for suggestion in parser.feed(chunk):
+                    if not first.done():
+                        first.set_result(suggestion['command'])
+                    await response.write(json.dumps(suggestion).encode() + b"\n")
+        for suggestion in parser.close():
+            await response.write(json.dumps(suggestion).encode() + b"\n")
+        if cached is None:
+            metrics.inc('opk_answers_total', kind='generate', source='model')
+            cache_put(namespace, query, "".join(received))
+    except asyncio.TimeoutError:
+        logging.warning(f"Model request timed out: {request.path}")
+        await response.write(json.dumps({'error': 'Model request timed out'}).encode() + b"\n")
+    except Exception as e:
+        logging.error(f"Error streaming response: {str(e)}")
+        await response.write(json.dumps({'error': str(e)}).encode() + b"\n")
+    await response.write_eof()
+    return response
 
 async def handle_quick_suggest(request):
-    data = await request.json()
-    query = data['query']
+    data, query = await read_query(request)
     system_info = get_system_info()
-    result = await get_single_best_result(query, "CLI", system_info)
+    result = await get_single_best_result(query, "CLI", system_info, use_cache=not data.get('no_cache'))
     return web.json_response({'result': result})
 
-async def shutdown(app):
-    print("Shutting down...")
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    [task.cancel() for task in tasks]
-    await asyncio.gather(*tasks, return_exceptions=True)
-    asyncio.get_event_loop().stop()
+class PrefetchBoard:
+    """The latest prefetch of each session, shared by all worker processes.
+
+    Keystrokes of one session can reach different workers, so after the
+    debounce a worker checks here that no newer prefetch replaced its own.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")  # Only matters for a few hundred milliseconds
+        self.db.execute("CREATE TABLE IF NOT EXISTS prefetches (session TEXT PRIMARY KEY, query TEXT NOT NULL)")
+
+    def post(self, session, query):
+        self.db.execute("INSERT OR REPLACE INTO prefetches (session, query) VALUES (?, ?)", (session, query))
+
+    def is_latest(self, session, query):
+        row = self.db.execute("SELECT query FROM prefetches WHERE session = ?", (session,)).fetchone()
+        return row is None or row[0] == query
+
+def init_prefetch_board(config_path, workers):
+    global prefetch_board
+    # A single process cancels superseded prefetches in prefetch_tasks already
+    if workers > 1 and config.getboolean('prefetch', 'enabled', fallback=True):
+        prefetch_board = PrefetchBoard(os.path.join(os.path.dirname(config_path), 'prefetch.db'))
+
+async def run_prefetch(query, system_info, session):
+    # Queued behind every real request by the scheduler; a prefetch that waits out
+    # request_timeout is dropped
+    request_priority.set('prefetch')
+    try:
+        # Superseded prefetches are cancelled while they sleep, before costing anything upstream
+        await asyncio.sleep(config.getfloat('prefetch', 'debounce', fallback=0.4))
+        if prefetch_board is not None and not prefetch_board.is_latest(session, query):
+            return
+        await get_single_best_result(query, "CLI", system_info)
+    except asyncio.CancelledError:
+        raise
+    except QuotaExceeded:
+        logging.info(f"Prefetch skipped, out of quota: {query}")
+    except Exception as e:
+        logging.warning(f"Prefetch failed: {str(e)}")
+
+async def handle_prefetch(request):
+    data, query = await read_query(request)
+    session = str(data.get('session', request.remote))
+
+    previous = prefetch_tasks.pop(session, None)
+    if previous is not None:
+        previous.cancel()
 
-def signal_handler(signame):
-    print(f"Received signal {signame}. Initiating shutdown...")
-    asyncio.create_task(shutdown(None))
+    if not config.getboolean('prefetch', 'enabled', fallback=True):
+        return web.json_response({'status': 'disabled'})
+    if prefetch_board is not None:
+        prefetch_board.post(session, query)
+    if len(query) < config.getint('prefetch', 'min_length', fallback=8):
+        return web.json_response({'status': 'skipped'})
+    # The buffer is heading towards a query the history already answers, nothing to warm up
+    if command_history is not None and command_history.complete(query) is not None:
+        return web.json_response({'status': 'history'})
+
+    task = asyncio.ensure_future(run_prefetch(query, get_system_info(), session))
+    prefetch_tasks[session] = task
+    task.add_done_callback(lambda _: prefetch_tasks.pop(session, None) if prefetch_tasks.get(session) is task else None)
+    return web.json_response({'status': 'scheduled'}, status=202)
+
+async def stop_background_tasks(app):
+    # Runs once the listeners are closed. Prefetches are only guesses, so unlike
+    # requests they are not worth waiting for.
+    for task in list(prefetch_tasks.values()):
+        task.cancel()
+    if 'health_check' in app:
+        app['health_check'].cancel()
+
+def create_app():
+    app = web.Application(middlewares=[instrument, limit_concurrency])
+    app.on_startup.append(start_background_health_check)
+    app.on_shutdown.append(stop_background_tasks)
+    app.router.add_get('/health', handle_health)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_post('/generate', handle_generate)
+    app.router.add_post('/generate_stream', handle_generate_stream)
+    app.router.add_post('/quick_suggest', handle_quick_suggest)
+    app.router.add_post('/prefetch', handle_prefetch)
+    app.router.add_post('/batch', handle_batch)
+    return app
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Option-K Server")
     parser.add_argument('--config', help='Path to custom config file')
     return parser.parse_args()
 
+def init_worker(config_path, workers=1):
+    """Set up what each server process needs of its own: connections, threads and backends."""
+    global executor, quick_executor
+    init_cache(config_path, shared=workers > 1)
+    init_local_index(config_path)
+    init_history(config_path)
+    init_prefetch_board(config_path, workers)
+    init_scheduler()
+    # Every call the scheduler admits may run a hedged second call next to it
+    executor = ThreadPoolExecutor(
+        max_workers=max(config.getint('optionk', 'max_workers', fallback=8), 2 * scheduler.total),
+        thread_name_prefix='opk-model'
+    )
+    quick_executor = ThreadPoolExecutor(
+        max_workers=2 * scheduler.limits['quick'],
+        thread_name_prefix='opk-quick'
+    )
+    init_backends(quota_share=1 / workers)
+
+def bind_unix_socket(path):
+    # Remove the socket a previous server left behind, like aiohttp does for a single process
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    return sock
+
+def make_sites(workers):
+    """Return a factory per listener that adds it to a worker's AppRunner.
+
+    With several workers the listeners are bound once, here, and inherited by
+    every worker, except on Linux where each worker binds the TCP port itself
+    with SO_REUSEPORT so the kernel spreads connections evenly between them.
+    """
+    port = int(config.get('optionk', 'port'))
+    host = 'localhost'
+    sites = []
+
+    logging.info(f"Starting server on http://{host}:{port}")
+    if workers == 1:
+        sites.append(lambda runner: web.TCPSite(runner, host, port))
+    elif platform.system() == "Linux":
+        sites.append(lambda runner: web.TCPSite(runner, host, port, reuse_port=True))
+    else:
+        tcp_socket = socket.create_server((host, port), backlog=128)
+        sites.append(lambda runner: web.SockSite(runner, tcp_socket))
+
+    if platform.system() == "Linux":
+        # Linux (systemd) specific configuration; the client reads the same key to find the socket
+        socket_path = config.get('optionk', 'socket', fallback=DEFAULT_SOCKET_PATH)
+        logging.info(f"Starting server on Unix socket: {socket_path}")
+        if workers == 1:
+            sites.append(lambda runner: web.UnixSite(runner, socket_path))
+        else:
+            unix_socket = bind_unix_socket(socket_path)
+            sites.append(lambda runner: web.SockSite(runner, unix_socket))
+    return sites
+
+async def serve(sites, on_ready=None):
+    """Serve until SIGINT or SIGTERM, then stop accepting and let requests in progress finish."""
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    # A request cannot take longer than request_timeout, so neither can draining
+    runner = web.AppRunner(create_app(), shutdown_timeout=config.getfloat('optionk', 'request_timeout', fallback=30))
+    await runner.setup()
+    for make_site in sites:
+        await make_site(runner).start()
+    if on_ready is not None:
+        on_ready()
+
+    await stopping.wait()
+    logging.info("Shutting down, finishing requests in progress")
+    await runner.cleanup()
+    executor.shutdown(wait=False, cancel_futures=True)
+    quick_executor.shutdown(wait=False, cancel_futures=True)
+
+class WorkerProcess:
+    def __init__(self, pid, generation, ready_fd):
+        self.pid = pid
+        self.generation = generation
+        self.ready_fd = ready_fd  # The worker writes one byte once it is listening
+        self.ready = False
+        self.retiring = False
+
+class Supervisor:
+    """Pre-fork master process keeping `workers` server processes running.
+
+    A worker that dies is replaced. SIGHUP re-reads the configuration and
+    starts a new generation of workers; the old ones are only told to finish
+    their requests and exit once all new ones are listening, so connections
+    are never refused. If the new workers fail to start, the old ones keep
+    serving with the old configuration. SIGINT or SIGTERM stop all workers
+    gracefully, a second one kills them.
+    """
+
+    def __init__(self, config_path, sites):
+        self.config_path = config_path
+        self.sites = sites
+        self.workers = {}
+        self.generation = 0
+        self.previous_config = None
+        self.deadline = None
+        self.failed = False
+        self.signals = deque()
+
+    def spawn(self):
+        workers = config.getint('optionk', 'workers', fallback=1)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Reloading is the master's job
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            code = 1
+            try:
+                init_worker(self.config_path, workers)
+                asyncio.run(serve(self.sites, on_ready=lambda: os.write(write_fd, b"1")))
+                code = 0
+            except Exception:
+                logging.exception("Worker failed")
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        self.workers[pid] = WorkerProcess(pid, self.generation, read_fd)
+
+    def start_generation(self):
+        self.generation += 1
+        for _ in range(config.getint('optionk', 'workers', fallback=1)):
+            self.spawn()
+
+    def reload(self):
+        logging.info("Reloading configuration and starting new workers")
+        self.previous_config = {section: dict(config[section]) for section in config.sections()}
+        config.clear()
+        config.read(self.config_path)
+        self.start_generation()
+
+    def stop(self):
+        if self.deadline is not None:
+            logging.info("Killing workers")
+            self.signal_workers(signal.SIGKILL)
+            return
+        logging.info("Stopping workers")
+        self.deadline = time.monotonic() + config.getfloat('optionk', 'request_timeout', fallback=30) + 5
+        self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, signum, workers=None):
+        for worker in list(self.workers.values()) if workers is None else workers:
+            try:
+                os.kill(worker.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def retire(self, workers):
+        for worker in workers:
+            worker.retiring = True
+        self.signal_workers(signal.SIGTERM, workers)
+
+    def check_ready(self, fd):
+        worker = next(worker for worker in self.workers.values() if worker.ready_fd == fd)
+        # An empty read means the worker exited before it was listening, reap() handles that
+        worker.ready = os.read(fd, 1) == b"1"
+        os.close(fd)
+        worker.ready_fd = None
+        current = [w for w in self.workers.values() if w.generation == self.generation]
+        if all(w.ready for w in current):
+            old = [w for w in self.workers.values() if w.generation < self.generation and not w.retiring]
+            if old:
+                logging.info(f"New workers are listening, stopping {len(old)} old workers")
+                self.retire(old)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+            if self.deadline is not None or worker.retiring:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if worker.ready:
+                logging.warning(f"Worker {pid} exited with {code}, starting a new one")
+                self.spawn()
+                continue
+            old = [w for w in self.workers.values() if w.generation < self.generation and not w.retiring]
+            if old:
+                logging.error(f"New worker {pid} failed to start (exit {code}), keeping the old workers and configuration")
+                self.retire([w for w in self.workers.values() if w.generation == self.generation])
+                config.clear()
+                config.read_dict(self.previous_config)
+                for w in old:
+                    w.generation = self.generation
+            else:
+                logging.error(f"Worker {pid} failed to start (exit {code})")
+                self.failed = True
+                self.stop()
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+        self.start_generation()
+        while self.workers:
+            starting = [worker.ready_fd for worker in self.workers.values() if worker.ready_fd is not None]
+            readable, _, _ = select.select(starting, [], [], 0.2)
+            for fd in readable:
+                self.check_ready(fd)
+            self.reap()
+            while self.signals:
+                if self.signals.popleft() == signal.SIGHUP:
+                    if self.deadline is None:
+                        self.reload()
+                else:
+                    self.stop()
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                logging.warning("Workers did not stop in time")
+                self.signal_workers(signal.SIGKILL)
+                self.deadline = math.inf
+        return 1 if self.failed else 0
+
 def run_server():
-    global config, model  # Add this line to use global variables
+    global config, system_info_path  # Add this line to use global variables
 
     args = parse_arguments()
     
@@ -273,63 +2610,33 @@ def run_server():
         print(f"Using configuration file: {config_path}")
     
     config.read(config_path)
+    workers = config.getint('optionk', 'workers', fallback=1)
 
     # Set up logging
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    log_format = '%(asctime)s - %(levelname)s - %(message)s'
+    if workers > 1:
+        log_format = '%(asctime)s - %(process)d - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_format)
+
+    if workers > 1 and not hasattr(os, 'fork'):
+        logging.warning("Worker processes need fork(), running a single process")
+        workers = 1
+
+    # Probed once here, so forked workers inherit it instead of each running the probe
+    system_info_path = os.path.join(os.path.dirname(config_path), 'sysinfo.json')
+    get_system_info()
 
-    # Check configuration and initialize AI model
+    if workers > 1:
+        # Nothing that starts threads or opens connections may run before the fork
+        sys.exit(Supervisor(config_path, make_sites(workers)).run())
+
+    # Check configuration and initialize AI model; the API itself is tested once the server is listening
     try:
-        if config.getboolean('vertexai', 'enabled', fallback=False):
-            vertexai.init(project=config.get('vertexai', 'project'), location=config.get('vertexai', 'location'))
-            model = GenerativeModel(config.get('vertexai', 'model'))
-            logging.info("Initialized Vertex AI model")
-        elif config.getboolean('google_ai_studio', 'enabled', fallback=False):
-            genai.configure(api_key=config.get('google_ai_studio', 'api_key'))
-            model = genai.GenerativeModel(config.get('google_ai_studio', 'model'))
-            logging.info("Initialized Google AI Studio model")
-        else:
-            raise ValueError("No AI service is enabled in the configuration")
-        
-        # Test API
-        test_query = "Hello, world!"
-        test_result = asyncio.run(get_single_best_result(test_query, "CLI", get_system_info()))
-        logging.info(f"API test successful. Response: {test_result}")
+        init_worker(config_path)
     except Exception as e:
         logging.error(f"Error initializing AI model: {str(e)}")
         return
-
-    app = web.Application()
-    app.router.add_post('/generate', handle_generate)
-    app.router.add_post('/quick_suggest', handle_quick_suggest)
-    
-    # Set up signal handlers
-    for signame in ('SIGINT', 'SIGTERM'):
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        loop.add_signal_handler(
-            getattr(signal, signame),
-            lambda: signal_handler(signame)
-        )
-
-    port = int(config.get('optionk', 'port'))
-    host = 'localhost'
-    
-    if platform.system() == "Darwin":
-        # macOS specific configuration
-        logging.info(f"Starting server on http://{host}:{port}")
-        web.run_app(app, port=port, host=host)
-    elif platform.system() == "Linux":
-        # Linux (systemd) specific configuration
-        socket_path = '/run/zerocoretwo/server.sock'
-        logging.info(f"Starting server on Unix socket: {socket_path}")
-        web.run_app(app, port=port, host=host, path=socket_path)
-    else:
-        # Default configuration
-        logging.info(f"Starting server on http://{host}:{port}")
-        web.run_app(app, port=port, host=host)
+    asyncio.run(serve(make_sites(1)))
 
 if __name__ == '__main__':
-    run_server()
\ No newline at end of file
+    run_server()
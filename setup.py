@@ -24,6 +24,10 @@ setup(
     license="MIT",
     packages=find_packages(include=["client", "server"]),
     install_requires=install_requires,
+    extras_require={
+        # Only bench/classifier.py uses it, to compare against the classifier it replaced
+        'bench': ['fuzzywuzzy==0.18.0', 'python-Levenshtein==0.25.1'],
+    },
     entry_points={
         'console_scripts': [
             'opk = client.opk:main',  # Replace `main` with the actual entry point
@@ -32,7 +36,7 @@ setup(
     },
     # Additional files to include
     package_data={
-        'optionk': ['config.ini', 'scripts/*.plist', 'scripts/*.sh'],
+        'optionk': ['config.ini', 'scripts/*.plist', 'scripts/*.sh', 'server/commands.tsv'],
     },
     include_package_data=True,
     classifiers=[
@@ -0,0 +1,56 @@
+import asyncio
+import os
+import sys
+
+from rich.console import Console
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from client import opk
+
+
+def test_run_command_result_is_recorded(tmp_path):
+    opk.console = Console(file=open(os.devnull, 'w'))
+    history = opk.HistoryStore(str(tmp_path / 'history.db'))
+    try:
+        exit_code, latency = asyncio.run(opk.run_command('echo hi'))
+        history.record('say hi', 'echo hi', exit_code, latency)
+
+        assert exit_code == 0
+        assert latency > 0
+        assert history.db.execute("SELECT command, exit_code FROM runs").fetchall() == [('echo hi', 0)]
+        assert history.complete('ech') == 'echo hi'
+    finally:
+        history.close()
+
+
+def test_run_command_that_cannot_start(tmp_path, monkeypatch):
+    opk.console = Console(file=open(os.devnull, 'w'))
+
+    async def fail(*args, **kwargs):
+        raise OSError("no shell")
+
+    async def run():
+        monkeypatch.setattr(asyncio.get_running_loop(), 'subprocess_shell', fail)
+        return await opk.run_command('echo hi')
+
+    assert asyncio.run(run()) == (None, 0.0)
+
+
+def test_auto_suggest_falls_back_to_offered_command(tmp_path):
+    from prompt_toolkit.buffer import Buffer
+    from prompt_toolkit.document import Document
+    from prompt_toolkit.history import InMemoryHistory
+
+    history = opk.HistoryStore(str(tmp_path / 'history.db'))
+    try:
+        history.record('list files', 'ls -la', 0, 0.1)
+        edit_history = InMemoryHistory()
+        edit_history.append_string('git log --oneline')
+        buffer = Buffer(history=edit_history)
+        auto_suggest = opk.history_auto_suggest(history)
+
+        assert auto_suggest.get_suggestion(buffer, Document('ls')).text == ' -la'
+        assert auto_suggest.get_suggestion(buffer, Document('git l')).text == 'og --oneline'
+    finally:
+        history.close()
@@ -0,0 +1,393 @@
+import importlib.util
+import os
+
+import pytest
+
+spec = importlib.util.spec_from_file_location(
+    'opk_server', os.path.join(os.path.dirname(__file__), '..', 'server', 'opk-server.py')
+)
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+
+
+def test_parse_suggestion_code_span_only_when_it_leads():
+    parse = server.parse_suggestion
+    assert parse("0. ls -la - List files; see `man ls` for flags")['command'] == 'ls -la'
+    assert parse("1. find . -name '*.log' - Find files such as `app.log`")['command'] == "find . -name '*.log'"
+    assert parse("2. `git status` - Show the working tree")['command'] == 'git status'
+    assert parse("3. **`du -sh *`** - Sizes")['command'] == 'du -sh *'
+
+
+def test_classify_query_prefers_named_tool_over_shared_verbs():
+    classify = server.classify_query
+    assert classify("docker pull nginx") == 'docker'
+    assert classify("push my docker image to the registry") == 'docker'
+    assert classify("docker commit a container") == 'docker'
+    assert classify("kubectl merge kubeconfig files") == 'kubectl'
+    assert classify("merge the feature branch") == 'git'
+    assert classify("git push to the docker remote") == 'git'
+    assert classify("restart nginx with systemctl") == 'systemctl'
+    assert classify("list files") is None
+
+
+def test_response_cache_drops_evicted_and_expired_keys_from_index(tmp_path):
+    index = server.QueryIndex(threshold=85)
+    cache = server.ResponseCache(str(tmp_path / 'cache.db'), ttl=60, memory_entries=0, disk_entries=10, index=index)
+    for i in range(50):
+        cache.put('generate', f'query number {i}', 'answer')
+    assert len(index.ids) == cache.disk_count <= 11
+
+    key = server.cache_key('generate', 'query number 49')
+    cache.db.execute("UPDATE responses SET created = 0 WHERE key = ?", (key,))
+    assert cache.get('generate', 'query number 49') is None
+    assert key not in index.ids
+
+
+def test_response_cache_peek_is_not_counted(tmp_path):
+    cache = server.ResponseCache(str(tmp_path / 'cache.db'), ttl=60, memory_entries=8, disk_entries=10)
+    cache.put('generate', 'list files', '0. ls - List files')
+    before = dict(server.metrics.series.get('opk_cache_lookups_total', {}))
+    assert cache.peek('generate', 'list files') == '0. ls - List files'
+    assert cache.peek('generate', 'other query') is None
+    assert server.metrics.series.get('opk_cache_lookups_total', {}) == before
+
+
+def test_first_command_skips_preamble():
+    first = server.first_command
+    assert first("Here is the command\nls -la\n") == 'ls -la'
+    assert first("Sure! Use this:\n```bash\ndu -sh *\n```\n") == 'du -sh *'
+    assert first("Run `df -h` to see free space.\n") == 'df -h'
+    assert first("```\nfor f in *.log; do\n  gzip \"$f\"\ndone\n```\n") == 'for f in *.log; do\n  gzip "$f"\ndone'
+    assert first("find . -name '*.py'\n") == "find . -name '*.py'"
+    assert first("Here is the command\n") is None
+    assert first("Here are the commands:\n0. ls -la - List files\n") == 'ls -la'
+
+
+def test_stream_is_hedged_until_first_chunk(monkeypatch):
+    import asyncio
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    def backend(name, latency, response):
+        return server.Backend(name, lambda system_instruction: server.FakeModel(
+            latency=latency, chunk_delay=0, response=response, system_instruction=system_instruction
+        ), dict, None)
+
+    slow = backend('fake/slow', 1.0, "0. slow - Slow\n")
+    fast = backend('fake/fast', 0.05, "0. fast - Fast\n")
+    pool = server.BackendPool([slow, fast], hedge_min_delay=0.1, hedge_max_delay=0.1)
+    monkeypatch.setattr(pool, 'ranked', lambda tokens: [slow, fast])
+    monkeypatch.setattr(server, 'backend_pool', pool)
+    monkeypatch.setattr(server, 'executor', ThreadPoolExecutor(4))
+
+    async def first_chunk():
+        started = time.perf_counter()
+        chunks = server.stream_backends(None, "list files", 64, asyncio.get_running_loop().time() + 5)
+        try:
+            return await chunks.__anext__(), time.perf_counter() - started
+        finally:
+            await chunks.aclose()
+
+    chunk, elapsed = asyncio.run(first_chunk())
+    assert chunk == "0. fast - Fast\n"
+    assert elapsed < 0.5
+
+
+def test_query_index_requires_the_same_leading_verb():
+    index = server.QueryIndex(threshold=85)
+    index.add('quick', "delete all stopped docker containers and dangling images", 'delete-containers')
+    index.add('quick', "remove the git branches already merged into main", 'remove-branches')
+    assert index.lookup('quick', "list all stopped docker containers and dangling images") is None
+    assert index.lookup('quick', "list the git branches already merged into main") is None
+    assert index.lookup('quick', "delete stopped docker containers and dangling image") == 'delete-containers'
+    assert index.lookup('quick', "please remove all git branches already merged into main") == 'remove-branches'
+
+
+def test_response_cache_replacing_a_row_does_not_evict(tmp_path):
+    cache = server.ResponseCache(str(tmp_path / 'cache.db'), ttl=60, memory_entries=8, disk_entries=100)
+    for i in range(60):
+        cache.put('quick', f'query number {i}', 'answer')
+    for _ in range(50):
+        cache.put('quick', 'query number 0', 'fresh answer')
+    assert cache.disk_count == 60
+    assert cache.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0] == 60
+
+
+def test_learned_quick_answers_stay_out_of_generate(tmp_path, monkeypatch):
+    learned = tmp_path / 'commands.tsv'
+    index = server.LocalCommandIndex(threshold=90, learned_path=str(learned))
+    monkeypatch.setattr(server, 'local_index', index)
+    index.learn("show the weather", "curl wttr.in")
+    assert server.local_quick_answer("show the weather") == 'curl wttr.in'
+    assert server.local_generate_answer("show the weather") is None
+
+    reloaded = server.LocalCommandIndex(threshold=90)
+    reloaded.load(str(learned), kind='quick')
+    assert reloaded.lookup("show the weather", quick=True) == [('curl wttr.in', '')]
+    assert reloaded.lookup("show the weather") is None
+
+
+def test_quick_does_not_wait_on_a_queued_generate_call(monkeypatch):
+    import asyncio
+
+    scheduler = server.PriorityScheduler({'quick': 4, 'generate': 1, 'batch': 1, 'prefetch': 1}, total=4)
+    monkeypatch.setattr(server, 'scheduler', scheduler)
+    query, system_info = "list open ports", "Linux"
+    system_query, _ = server.build_generate_query(query, "CLI", system_info)
+    key = server.cache_key(server.cache_namespace('generate', system_query, system_info), query)
+
+    async def generate(started):
+        with server.publish_first_suggestion(key) as first:
+            async with server.upstream_slot():
+                started.set()
+                first.set_result("ss -tulpn")
+                await asyncio.sleep(0.1)
+
+    async def run():
+        blocker = server.Ticket('generate')
+        await scheduler.acquire(blocker)
+        started = asyncio.Event()
+        call = asyncio.ensure_future(generate(started))
+        await asyncio.sleep(0)
+        # Queued behind the blocker: a quick request must not wait for it
+        assert await asyncio.wait_for(server.generate_quick_answer(query, "CLI", system_info), 0.05) is None
+        scheduler.release(blocker)
+        await started.wait()
+        answer = await server.generate_quick_answer(query, "CLI", system_info)
+        await call
+        return answer
+
+    assert asyncio.run(run()) == "ss -tulpn"
+
+
+def make_scheduler(total=1):
+    return server.PriorityScheduler({'quick': 2, 'generate': 2, 'batch': 2, 'prefetch': 2}, total=total, aging=5.0)
+
+
+def test_scheduler_starts_waiting_calls_by_priority():
+    import asyncio
+
+    async def run():
+        scheduler = make_scheduler()
+        blocker = server.Ticket('generate')
+        await scheduler.acquire(blocker)
+        order = []
+
+        async def call(priority_class):
+            ticket = server.Ticket(priority_class)
+            await scheduler.acquire(ticket)
+            order.append(priority_class)
+            scheduler.release(ticket)
+
+        tasks = [asyncio.ensure_future(call(name)) for name in ('prefetch', 'batch', 'generate')]
+        await asyncio.sleep(0)
+        assert [scheduler.depth(name) for name in ('generate', 'batch', 'prefetch')] == [1, 1, 1]
+        scheduler.release(blocker)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ['generate', 'batch', 'prefetch']
+
+
+def test_scheduler_quick_calls_bypass_the_shared_limit():
+    import asyncio
+
+    async def run():
+        scheduler = make_scheduler()
+        await scheduler.acquire(server.Ticket('batch'))
+        quick = server.Ticket('quick')
+        await asyncio.wait_for(scheduler.acquire(quick), 0.1)
+        generate = server.Ticket('generate')
+        waiting = asyncio.ensure_future(scheduler.acquire(generate))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        waiting.cancel()
+        return scheduler.running
+
+    assert asyncio.run(run()) == {'quick': 1, 'generate': 0, 'batch': 1, 'prefetch': 0}
+
+
+def test_scheduler_aging_lets_old_low_priority_calls_go_first(monkeypatch):
+    import asyncio
+
+    now = [100.0]
+    monkeypatch.setattr(server.time, 'monotonic', lambda: now[0])
+
+    async def run():
+        scheduler = make_scheduler()
+        blocker = server.Ticket('generate')
+        await scheduler.acquire(blocker)
+        prefetch, generate = server.Ticket('prefetch'), server.Ticket('generate')
+        waiting_prefetch = asyncio.ensure_future(scheduler.acquire(prefetch))
+        await asyncio.sleep(0)
+        now[0] += 11  # Two aging steps and a bit: prefetch now ranks above a fresh generate
+        waiting_generate = asyncio.ensure_future(scheduler.acquire(generate))
+        await asyncio.sleep(0)
+        scheduler.release(blocker)
+        await asyncio.sleep(0)
+        result = waiting_prefetch.done(), waiting_generate.done()
+        waiting_generate.cancel()
+        return result
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_scheduler_promote_while_queued():
+    import asyncio
+
+    async def run():
+        scheduler = make_scheduler(total=1)
+        await scheduler.acquire(server.Ticket('generate'))
+        ticket = server.Ticket('prefetch')
+        waiting = asyncio.ensure_future(scheduler.acquire(ticket))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        # A quick joiner lifts the queued call into the quick class, which has slots free
+        scheduler.promote(ticket, 'quick')
+        await asyncio.sleep(0)
+        assert waiting.done() and ticket.running_class == 'quick'
+        # Lower classes never demote it
+        scheduler.promote(ticket, 'batch')
+        assert ticket.priority_class == 'quick'
+        scheduler.release(ticket)
+        return scheduler.running
+
+    assert asyncio.run(run()) == {'quick': 0, 'generate': 1, 'batch': 0, 'prefetch': 0}
+
+
+def test_scheduler_cancel_while_queued_leaks_nothing():
+    import asyncio
+
+    async def run():
+        scheduler = make_scheduler()
+        blocker = server.Ticket('generate')
+        await scheduler.acquire(blocker)
+        ticket = server.Ticket('batch')
+        waiting = asyncio.ensure_future(scheduler.acquire(ticket))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.waiting == [] and scheduler.depth('batch') == 0
+        scheduler.release(blocker)
+        # The freed slot is still usable
+        await asyncio.wait_for(scheduler.acquire(server.Ticket('batch')), 0.1)
+        return scheduler.running
+
+    assert asyncio.run(run()) == {'quick': 0, 'generate': 0, 'batch': 1, 'prefetch': 0}
+
+
+def test_upstream_slot_releases_on_timeout(monkeypatch):
+    import asyncio
+
+    async def run():
+        scheduler = make_scheduler()
+        monkeypatch.setattr(server, 'scheduler', scheduler)
+        await scheduler.acquire(server.Ticket('generate'))
+        try:
+            async with server.upstream_slot(timeout=0.01):
+                pass
+        except asyncio.TimeoutError:
+            pass
+        return scheduler.waiting, scheduler.running
+
+    assert asyncio.run(run()) == ([], {'quick': 0, 'generate': 1, 'batch': 0, 'prefetch': 0})
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_reserve_refund_settle(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'monotonic', clock)
+    # One request and 100 tokens a second, with five seconds of burst
+    limiter = server.RateLimiter(requests_per_minute=60, tokens_per_minute=6000, burst=5)
+    assert [limiter.reserve(100) for _ in range(5)] == [0.0] * 5
+    assert limiter.reserve(100) == 1.0
+    assert limiter.delay(100) == 2.0
+
+    limiter.refund(100)
+    assert limiter.stats() == {'requests_left': 0.0, 'tokens_left': 0, 'paused': 0}
+
+    # The call only used 40 of the 100 tokens it reserved
+    limiter.settle(100, 40)
+    assert limiter.stats()['tokens_left'] == 60
+    clock.now += 2
+    assert limiter.stats() == {'requests_left': 2.0, 'tokens_left': 260, 'paused': 0}
+
+
+def test_rate_limiter_pauses_for_the_retry_hint(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'monotonic', clock)
+    monkeypatch.setattr(server.random, 'uniform', lambda low, high: high)
+    limiter = server.RateLimiter(requests_per_minute=600)
+    error = RuntimeError("429 Resource exhausted. Please retry in 14.2s")
+    assert server.retry_after_hint(error) == 14.2
+
+    assert limiter.backoff(server.retry_after_hint(error)) == 14.2
+    assert limiter.failures == 0
+    assert limiter.delay(0) == pytest.approx(14.2)
+    # Calls waiting for the pause to end are spread over it
+    assert limiter.reserve(0) == pytest.approx(28.4)
+    clock.now += 15
+    assert limiter.delay(0) == 0
+
+
+def test_rate_limiter_backs_off_with_jitter(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'monotonic', clock)
+    draws = []
+
+    def uniform(low, high):
+        draws.append((low, high))
+        return high
+
+    monkeypatch.setattr(server.random, 'uniform', uniform)
+    limiter = server.RateLimiter(backoff_base=1, backoff_max=3)
+    assert limiter.backoff() == 1.0
+    assert draws == [(0, 0.5)]
+    # Other calls' 429s during the pause don't escalate it
+    assert limiter.backoff() is None
+    assert limiter.failures == 1
+
+    pauses = []
+    for _ in range(3):
+        clock.now += 10
+        pauses.append(limiter.backoff())
+    assert pauses == [2.0, 3.0, 3.0]
+
+    limiter.succeeded()
+    clock.now += 10
+    assert limiter.backoff() == 1.0
+
+
+def test_backend_pool_sheds_low_priority_calls_without_quota(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server.time, 'monotonic', clock)
+    backends = [
+        server.Backend(f"fake/{name}", None, dict, None, limiter=server.RateLimiter(requests_per_minute=60, burst=1))
+        for name in ('a', 'b')
+    ]
+    pool = server.BackendPool(backends, shed=['batch', 'prefetch'])
+
+    def admit(priority_class):
+        token = server.request_priority.set(priority_class)
+        try:
+            pool.admit(10)
+        finally:
+            server.request_priority.reset(token)
+
+    admit('batch')
+    backends[0].limiter.reserve(10)
+    admit('batch')  # The other backend still has quota
+    backends[1].limiter.reserve(10)
+    with pytest.raises(server.QuotaExceeded) as raised:
+        admit('prefetch')
+    assert raised.value.retry_after == 1.0
+    admit('quick')  # Only the classes in shed are turned away
+    clock.now += 1
+    admit('batch')